@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Benchmarks of the recreate pipeline on synthetic ISMIP-HOM data.
+
+Synthetic data files for experiments A, C and F are generated at a given size:
+the number of points per file, the number of models per experiment and length,
+and the layout of the points (a structured lattice, or scattered points), with
+the Exp. F files in x_hat or in x (km) coordinates. The whole pipeline is then
+run on them with profiling on (see ismip_profile), at a given grid resolution
+(points_p_quarter), and the time spent ingesting, interpolating, computing the
+ensemble statistics and rendering is recorded.
+
+Nothing is downloaded; the data is generated in a temporary directory. The
+results are saved as json, along with the code and library versions, so runs
+of different versions can be compared:
+
+    python ismip_benchmark.py --points 1000 10000 --models 4 16 --out new.json
+    python ismip_benchmark.py --compare old.json new.json
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+
+import numpy
+import scipy
+
+import recreate
+import ismip_parse
+import ismip_interp
+import ismip_profile
+
+
+# The lengths of each experiment the figures are made from
+lengths = {'a': ['005','010','020','040','080','160'],
+           'c': ['005','010','020','040','080','160'],
+           'f': ['000','001'],
+          }
+
+# The stages reported, and the profile stages each is made up of; stages may
+# overlap (e.g. interpolation includes triangulation, and loading the data when
+# it's run in worker processes)
+stages = [('ingest',      ['load']),
+          ('interpolate', ['interpolate']),
+          ('triangulate', ['triangulate']),
+          ('statistics',  ['ensemble']),
+          ('write',       ['write_stats', 'bundle']),
+          ('render',      ['render']),
+          ('total',       ['main']),
+         ]
+
+
+def points_xy(points, layout, rng):
+    """
+    Return (x_hat, y_hat) columns of about `points` points in the unit square,
+    on a lattice (x_hat major, like the ISMIP-HOM files), or scattered. Scattered
+    points include the square's corners and edges so the whole grid is covered.
+    """
+    if layout == 'structured':
+        n = max(2, int(round(numpy.sqrt(points))))
+        x, y = numpy.meshgrid(numpy.linspace(0.0, 1.0, n), numpy.linspace(0.0, 1.0, n), indexing='ij')
+        return x.ravel(), y.ravel()
+
+    n = max(2, int(numpy.sqrt(points)//4))
+    edge = numpy.linspace(0.0, 1.0, n, endpoint=False)
+    x = numpy.concatenate([edge, numpy.ones(n), 1.0-edge, numpy.zeros(n)])
+    y = numpy.concatenate([numpy.zeros(n), edge, numpy.ones(n), 1.0-edge])
+    inner = max(0, points - x.size)
+    x = numpy.concatenate([x, rng.uniform(0.0, 1.0, inner)])
+    y = numpy.concatenate([y, rng.uniform(0.0, 1.0, inner)])
+    return x, y
+
+
+def synthetic_data(exp, points, layout, rng, f_coords='x_hat'):
+    """
+    Return an array of synthetic data for an experiment, with the columns of
+    the ISMIP-HOM data standards (see ismip_parse.header). The fields are
+    smooth, with a random amplitude and phase for each model.
+    """
+    x, y = points_xy(points, layout, rng)
+    amp = rng.uniform(0.8, 1.2, 4)
+    phase = rng.uniform(-0.05, 0.05, 4)
+    wave = lambda i: numpy.sin(2.0*numpy.pi*(x+phase[i]))*numpy.cos(2.0*numpy.pi*(y+phase[i]))
+
+    columns = {'x_hat': x, 'y_hat': y,
+               'vx_surf': 20.0 + 10.0*amp[0]*wave(0), 'vy_surf': 2.0*amp[1]*wave(1),
+               'vz_surf': 0.5*amp[2]*wave(2),
+               'vx_base': 5.0 + 2.0*amp[0]*wave(0), 'vy_base': 0.5*amp[1]*wave(1),
+               'tau_xz': 50.0 + 20.0*amp[3]*wave(3), 'tau_yz': 5.0*amp[3]*wave(1),
+               'del_p': amp[2]*wave(2),
+               'z_surf': 10.0*amp[0]*wave(0)*numpy.exp(-8.0*((x-0.5)**2 + (y-0.5)**2)),
+               'vx': 100.0 + 2.0*amp[1]*wave(1), 'vy': 0.1*amp[2]*wave(2), 'vz': 0.01*amp[3]*wave(3),
+              }
+    if exp == 'f' and f_coords == 'x':
+        columns['x_hat'] = (x - 0.5)*100.0
+        columns['y_hat'] = (y - 0.5)*100.0
+    return numpy.column_stack([columns[name] for name in ismip_parse.header[exp]])
+
+
+def generate(tree, points, models, layout='structured', f_coords='x_hat', seed=0):
+    """
+    Write synthetic data files for experiments A, C and F, for every length, to
+    tree. Each experiment and length has `models` models (at least 2), named
+    after ISMIP-HOM full-Stokes and higher-order models in turn (in numbered
+    subdirectories when there are more models than names). Returns the list of
+    files written.
+    """
+    rng = numpy.random.RandomState(seed)
+    fs, ho = recreate.full_stokes, recreate.higher_order
+    names = [m for pair in zip(fs, ho) for m in pair] + fs[len(ho):] + ho[len(fs):]
+    files = []
+    for exp in ['a', 'c', 'f']:
+        for l in lengths[exp]:
+            for i in range(models):
+                model_dir = os.path.join(tree, 'set{:03d}'.format(i//len(names)))
+                recreate.mkdir_p(model_dir)
+                data_file = os.path.join(model_dir, names[i % len(names)]+exp+l+'.txt')
+                data = synthetic_data(exp, points, layout, rng, f_coords)
+                numpy.savetxt(data_file, data, fmt='%.8e', delimiter='  ')
+                files.append(data_file)
+    return files
+
+
+def run(points, models, layout='structured', f_coords='x_hat', points_p_quarter=25,
+        workers=1, render=True, trace_memory=False, seed=0):
+    """
+    Generate a synthetic data set and run the recreate pipeline on it, from a
+    cold cache. Returns a dict of the total wall time (s) of each stage (see
+    stages), the largest peak memory (bytes, if traced) and the data size.
+    """
+    work = tempfile.mkdtemp(prefix='ismip_bench_')
+    settings = dict((name, getattr(recreate, name)) for name in
+                    ['ismip_data', 'out_path', 'cache_path', 'points_p_quarter', 'workers',
+                     'headless', 'usetex', 'bundle_file', 'dry_run', 'profile_file', 'profile_summary'])
+    render_all = recreate.render_all
+    try:
+        files = generate(os.path.join(work, 'data'), points, models, layout, f_coords, seed)
+
+        recreate.ismip_data = os.path.join(work, 'data')
+        recreate.out_path = os.path.join(work, 'output')+os.sep
+        recreate.cache_path = os.path.join(work, 'cache')+os.sep
+        recreate.points_p_quarter = points_p_quarter
+        recreate.workers = workers
+        recreate.headless = True
+        recreate.usetex = False
+        recreate.bundle_file = None
+        recreate.dry_run = False
+        ismip_interp._triangulations.clear()
+        if not render:
+            recreate.render_all = lambda figures, workers=1: None
+
+        ismip_profile.take()
+        ismip_profile.enable(trace_memory)
+        try:
+            with ismip_profile.stage('main'):
+                recreate.run()
+        finally:
+            records = ismip_profile.take()
+            ismip_profile.disable()
+    finally:
+        recreate.render_all = render_all
+        for name, value in settings.items():
+            setattr(recreate, name, value)
+        shutil.rmtree(work, ignore_errors=True)
+
+    result = {'files': len(files), 'points': points, 'models': models, 'layout': layout,
+              'f_coords': f_coords, 'points_p_quarter': points_p_quarter, 'workers': workers}
+    for name, parts in stages:
+        result[name] = sum(r['wall'] for r in records if r['stage'] in parts)
+    peaks = [r['peak_mem'] for r in records if r['peak_mem'] is not None]
+    result['peak_mem'] = max(peaks) if peaks else None
+    return result
+
+
+def versions():
+    """The code and library versions the benchmarks were run with."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'code_version': recreate.code_version(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+           }
+
+
+def config_key(result):
+    return (result['points'], result['models'], result['layout'], result['f_coords'],
+            result['points_p_quarter'], result['workers'])
+
+
+def print_results(results, header=True):
+    names = [name for name, parts in stages]
+    if header:
+        print("{:>8s} {:>6s} {:<10s} {:<5s} {:>4s} {:>5s}".format('points', 'models', 'layout', 'F', 'ppq', 'files') +
+              ''.join("{:>12s}".format(n) for n in names))
+    for r in results:
+        print("{:8d} {:6d} {:<10s} {:<5s} {:4d} {:5d}".format(r['points'], r['models'], r['layout'], r['f_coords'],
+                                                            r['points_p_quarter'], r['files']) +
+              ''.join("{:11.3f}s".format(r[n]) for n in names))
+
+
+def compare(old, new):
+    """Print the ratio of new to old stage times for the configurations in both."""
+    old_results = dict((config_key(r), r) for r in old['results'])
+    names = [name for name, parts in stages]
+    print("old: "+str(old['versions'].get('commit'))+"  new: "+str(new['versions'].get('commit'))+"  (new/old time)")
+    print("{:>8s} {:>6s} {:<10s} {:<5s} {:>4s}".format('points', 'models', 'layout', 'F', 'ppq') +
+          ''.join("{:>12s}".format(n) for n in names))
+    for r in new['results']:
+        o = old_results.get(config_key(r))
+        if o is None:
+            continue
+        print("{:8d} {:6d} {:<10s} {:<5s} {:4d}".format(r['points'], r['models'], r['layout'], r['f_coords'],
+                                                      r['points_p_quarter']) +
+              ''.join("{:11.2f}x".format(r[n]/o[n]) if o[n] else "{:>12s}".format('-') for n in names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the recreate pipeline on synthetic ISMIP-HOM data.')
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 10000],
+                        help='Numbers of points per data file.')
+    parser.add_argument('--models', type=int, nargs='+', default=[4],
+                        help='Numbers of models per experiment and length.')
+    parser.add_argument('--ppq', type=int, nargs='+', default=[25],
+                        help='Grid resolutions (points per quarter of x_hat/y_hat).')
+    parser.add_argument('--layouts', nargs='+', default=['structured', 'scattered'],
+                        choices=['structured', 'scattered'], help='Layouts of the data points.')
+    parser.add_argument('--f-coords', nargs='+', default=['x_hat', 'x'], choices=['x_hat', 'x'],
+                        help='Coordinates of the Exp. F data.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes.')
+    parser.add_argument('--no-render', action='store_true', help="Don't render the figures.")
+    parser.add_argument('--memory', action='store_true', help='Trace the peak memory (slower).')
+    parser.add_argument('--out', help='Save the results to this json file.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two saved results instead of running the benchmarks.')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        sys.exit()
+
+    results = []
+    for points, models, ppq, layout, f_coords in itertools.product(args.points, args.models, args.ppq,
+                                                                   args.layouts, args.f_coords):
+        results.append(run(points, models, layout, f_coords, ppq, args.workers,
+                           render=not args.no_render, trace_memory=args.memory))
+        print_results(results[-1:], header=len(results) == 1)
+        sys.stdout.flush()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'versions': versions(), 'results': results}, f, indent=1, sort_keys=True)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+A make-like record of the output artifacts and what they were built from.
+
+Each artifact (an output file) is added with a json-able description of its
+dependencies, e.g. the content hashes of the data files, the grid settings and
+the code version. The description is hashed into a signature, and an artifact
+is stale if its file is missing or its signature differs from the one it was
+last built with. Only stale artifacts need to be rebuilt.
+"""
+
+
+import os
+import sys
+import json
+import inspect
+import hashlib
+import tempfile
+
+
+def signature(deps):
+    """Return the sha1 of a json-able description of dependencies."""
+    return hashlib.sha1(json.dumps(deps, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def source_hash(modules):
+    """
+    Return a hash of the source files of the given modules (or module names),
+    or of the source of given functions, to use as the code version of the
+    artifacts built with them.
+    """
+    sha = hashlib.sha1()
+    for module in modules:
+        if isinstance(module, str):
+            module = sys.modules[module]
+        if inspect.ismodule(module):
+            source = os.path.splitext(module.__file__)[0]+'.py'
+            with open(source, 'rb') as f:
+                sha.update(f.read())
+        else:
+            sha.update(inspect.getsource(module).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class build_graph(object):
+    """
+    The artifacts of a build, and the signatures they were last built with,
+    which are kept in manifest_file.
+    """
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.targets = {}
+        try:
+            with open(manifest_file) as f:
+                self.built = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.built = {}
+
+    def add(self, target, deps):
+        """Add an artifact, and a json-able description of its dependencies."""
+        self.targets[target] = signature(deps)
+
+    def is_stale(self, target):
+        """Whether an artifact is missing or its dependencies have changed."""
+        return not os.path.isfile(target) or self.built.get(target) != self.targets[target]
+
+    def stale(self):
+        """Return the sorted list of stale artifacts."""
+        return sorted(t for t in self.targets if self.is_stale(t))
+
+    def done(self, target):
+        """Record that an artifact has been built from its current dependencies."""
+        self.built[target] = self.targets[target]
+
+    def save(self):
+        """Save the signatures of the built artifacts to the manifest file."""
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_file))
+        fd, tmp = tempfile.mkstemp(dir=manifest_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.built, f, indent=0, sort_keys=True)
+            os.rename(tmp, self.manifest_file)
+        except:
+            os.remove(tmp)
+            raise
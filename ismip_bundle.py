@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+A single, self-describing binary bundle of the ensemble statistics.
+
+The bundle is a NetCDF (classic format) file, written and read with
+scipy.io.netcdf_file, holding for each figure (e.g. ExpA_Fig5):
+    <figure>_min, _max, _mean, _std  (order, <figure>_length, <axis>)
+    <figure>_count                   (order, <figure>_length)
+    <figure>_length                  (<figure>_length), the L (or slip) codes
+along with the x_hat/y_hat axes, the model orders, and provenance metadata as
+attributes. Reading memory-maps the file, so one figure/length/order can be
+sliced out without loading the rest.
+"""
+
+
+import time
+import numpy
+
+
+# Version of the bundle layout
+version = 1
+
+orders = ['full_stokes', 'higher_order']
+
+
+def write(out_file, figures, attrs=None):
+    """
+    Write the ensemble statistics of figures to a bundle. figures is a list of
+    dicts, each with:
+        name       -- the figure's name, e.g. ExpA_Fig5
+        lengths    -- the length codes, e.g. ['005', ..., '160']
+        axis_name  -- 'x_hat' or 'y_hat'
+        axis       -- the axis the statistics are along
+        stats      -- the ensemble_stats, keyed by (order, length)
+        members    -- the member models' names, keyed by (order, length)
+    and any other (string) items are written as attributes of the figure's
+    variables. attrs are written as global attributes.
+    """
+    from scipy.io import netcdf_file
+    nc = netcdf_file(out_file, 'w', version=2)
+    try:
+        nc.title = 'ISMIP-HOM ensemble statistics'
+        nc.history = time.strftime('%Y-%m-%d %H:%M:%S')+' created'
+        nc.bundle_version = version
+        nc.orders = ' '.join(orders)
+        for name, value in sorted((attrs or {}).items()):
+            setattr(nc, name, value)
+
+        nc.createDimension('order', len(orders))
+        strlen = max(len(o) for o in orders)
+        nc.createDimension('order_strlen', strlen)
+        order = nc.createVariable('order', 'c', ('order', 'order_strlen'))
+        order[:] = numpy.array([list(o.ljust(strlen)) for o in orders], dtype='S1')
+
+        for figure in figures:
+            name, axis_name = figure['name'], figure['axis_name']
+            if axis_name not in nc.dimensions:
+                nc.createDimension(axis_name, len(figure['axis']))
+                axis = nc.createVariable(axis_name, 'd', (axis_name,))
+                axis[:] = figure['axis']
+
+            length_dim = name+'_length'
+            nc.createDimension(length_dim, len(figure['lengths']))
+            length = nc.createVariable(length_dim, 'i', (length_dim,))
+            length[:] = [int(l) for l in figure['lengths']]
+
+            shape = (len(orders), len(figure['lengths']), len(figure['axis']))
+            arrays = dict((s, numpy.full(shape, numpy.nan)) for s in ['min', 'max', 'mean', 'std'])
+            count = numpy.zeros(shape[:2], dtype='i')
+            for i, o in enumerate(orders):
+                for j, l in enumerate(figure['lengths']):
+                    stats = figure['stats'].get((o, l))
+                    if stats is None or not stats.count:
+                        continue
+                    count[i,j] = stats.count
+                    arrays['min'][i,j] = stats.amin
+                    arrays['max'][i,j] = stats.amax
+                    arrays['mean'][i,j] = stats.mean
+                    arrays['std'][i,j] = stats.std
+
+            for s in ['min', 'max', 'mean', 'std']:
+                var = nc.createVariable(name+'_'+s, 'd', ('order', length_dim, axis_name))
+                var[:] = arrays[s]
+                for key, value in figure.items():
+                    if isinstance(value, str):
+                        setattr(var, key, value)
+            var = nc.createVariable(name+'_count', 'i', ('order', length_dim))
+            var[:] = count
+            for (o, l), models in sorted(figure['members'].items()):
+                setattr(var, 'members_'+o+'_'+l, ' '.join(models))
+    finally:
+        nc.close()
+
+
+def open_bundle(bundle_file):
+    """Open a bundle, memory-mapped, as a scipy.io.netcdf_file."""
+    from scipy.io import netcdf_file
+    return netcdf_file(bundle_file, 'r', mmap=True)
+
+
+def figures(bundle_file):
+    """Return the names of the figures in a bundle."""
+    nc = open_bundle(bundle_file)
+    try:
+        return sorted(name[:-len('_count')] for name in nc.variables if name.endswith('_count'))
+    finally:
+        nc.close()
+
+
+def read(bundle_file, figure, length=None, order=None):
+    """
+    Read the statistics of a figure from a bundle, for one length code (e.g.
+    '005') and/or order (e.g. 'full_stokes'), or all of them.
+
+    Returns a dict of the axis, lengths, min, max, mean, std and count arrays;
+    only the requested slices are read from the file.
+    """
+    nc = open_bundle(bundle_file)
+    try:
+        file_orders = nc.orders.decode().split() if isinstance(nc.orders, bytes) else nc.orders.split()
+        lengths = nc.variables[figure+'_length'][:].copy()
+        index = (slice(None) if order is None else file_orders.index(order),
+                 slice(None) if length is None else list(lengths).index(int(length)))
+
+        axis_name = nc.variables[figure+'_mean'].dimensions[-1]
+        results = {'axis': nc.variables[axis_name][:].copy(),
+                   'axis_name': axis_name,
+                   'lengths': lengths if length is None else lengths[index[1]],
+                   'count': numpy.array(nc.variables[figure+'_count'][index]),
+                  }
+        for s in ['min', 'max', 'mean', 'std']:
+            results[s] = numpy.array(nc.variables[figure+'_'+s][index])
+        return results
+    finally:
+        nc.close()
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+A binary cache for the ISMIP-HOM text files.
+
+Each data file is parsed once (see ismip_parse) and stored as a .npy array in
+the cache directory, along with a small json record of the source file(s) it
+came from.
+Later loads of an unchanged file read the .npy instead of re-parsing the text.
+
+The fields interpolated from each data file are kept in the interp/
+subdirectory, keyed by the file's contents and the interpolation settings.
+This part of the cache is size-bounded; the least recently used entries are
+evicted first.
+
+Data files submitted to ismip_serve are kept in the submissions/ subdirectory,
+by content.
+
+Run this module directly to compare cold and warm load times, or to inspect or
+clear the cache:
+
+    python ismip_cache.py [ismip_data]
+    python ismip_cache.py --info
+    python ismip_cache.py --clear
+"""
+
+
+import os
+import sys
+import json
+import time
+import numpy
+import argparse
+import errno
+import shutil
+import fnmatch
+import hashlib
+import tempfile
+import weakref
+import atexit
+
+import ismip_parse
+import ismip_build
+import ismip_profile
+
+
+# Default location of the cache
+cache_path = './cache/'
+
+
+def mkdir_p(path):
+    """
+    Make parent directories as needed and no error if existing. Works like `mkdir -p`.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as exc: # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else: raise
+
+
+def file_hash(data_file):
+    """Return the sha1 hex digest of a file's contents."""
+    sha = hashlib.sha1()
+    with open(data_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(data_file):
+    """Return the cache entry name for a data file; based on its absolute path."""
+    path = os.path.abspath(data_file)
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+
+def _entry_paths(data_file, cache_dir):
+    key = cache_key(data_file)
+    return (os.path.join(cache_dir, key+'.npy'), os.path.join(cache_dir, key+'.json'))
+
+
+def _read_record(record_file):
+    try:
+        with open(record_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_atomic(path, write):
+    """Write a file through a temporary in the same directory, then move it into place."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def _source_record(source):
+    stat = os.stat(source)
+    return {'path': os.path.abspath(source),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': file_hash(source),
+           }
+
+
+def _combined_hash(source_records):
+    if len(source_records) == 1:
+        return source_records[0]['sha1']
+    sha = hashlib.sha1()
+    for record in source_records:
+        sha.update(record['sha1'].encode('utf-8'))
+    return sha.hexdigest()
+
+
+_parser_code = None
+
+def parser_code():
+    """
+    A hash of the parser and its adapters (see ismip_build.source_hash), taken
+    once from the code running; data parsed by other code isn't current.
+    """
+    global _parser_code
+    if _parser_code is None:
+        _parser_code = ismip_build.source_hash([ismip_parse])
+    return _parser_code
+
+
+def is_current(data_file, cache_dir=None):
+    """
+    Check whether the cache holds an up to date copy of a data file.
+
+    An entry is current if it was parsed by the same parser code (see
+    parser_code) and the size and mtime of each source file the data is read
+    from (see ismip_parse.sources) match the record. If only an mtime has
+    changed (e.g. a fresh checkout), the content hash is compared instead and
+    the record is refreshed when it still matches.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    array_file, record_file = _entry_paths(data_file, cache_dir)
+    record = _read_record(record_file)
+    if record is None or 'sources' not in record or not os.path.isfile(array_file):
+        return False
+    if record.get('parser') != parser_code():
+        return False
+
+    sources = [os.path.abspath(source) for source in ismip_parse.sources(data_file)]
+    if sources != [source['path'] for source in record['sources']]:
+        return False
+
+    refresh = False
+    for source in record['sources']:
+        stat = os.stat(source['path'])
+        if source['size'] != stat.st_size:
+            return False
+        if source['mtime'] == stat.st_mtime:
+            continue
+        if source['sha1'] != file_hash(source['path']):
+            return False
+        source['mtime'] = stat.st_mtime
+        refresh = True
+
+    if refresh:
+        _write_atomic(record_file, lambda f: f.write(json.dumps(record).encode('utf-8')))
+    return True
+
+
+def store(data_file, array, cache_dir=None):
+    """Store the parsed array for a data file in the cache."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    mkdir_p(cache_dir)
+    array_file, record_file = _entry_paths(data_file, cache_dir)
+
+    sources = [_source_record(source) for source in ismip_parse.sources(data_file)]
+    record = {'source': os.path.abspath(data_file),
+              'sources': sources,
+              'sha1': _combined_hash(sources),
+              'parser': parser_code(),
+              'shape': list(array.shape),
+             }
+    _write_atomic(array_file, lambda f: numpy.save(f, numpy.ascontiguousarray(array)))
+    _write_atomic(record_file, lambda f: f.write(json.dumps(record).encode('utf-8')))
+
+
+def load(data_file, loader=ismip_parse.load, cache_dir=None, mmap_mode=None):
+    """
+    Load a data file through the cache.
+
+    If the cache holds a current copy it is read from the .npy file (memory
+    mapped if `mmap_mode` is given), otherwise the file is parsed with `loader`
+    and the result is stored for next time.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    if is_current(data_file, cache_dir):
+        array_file, _ = _entry_paths(data_file, cache_dir)
+        try:
+            return numpy.load(array_file, mmap_mode=mmap_mode)
+        except (IOError, OSError, ValueError):
+            pass # corrupt entry; fall through and rebuild it
+
+    with ismip_profile.stage('parse', file=data_file):
+        array = loader(data_file)
+    try:
+        store(data_file, array, cache_dir)
+    except (IOError, OSError):
+        pass # a read-only cache shouldn't stop us from loading the data
+    return array
+
+
+def clear(cache_dir=None):
+    """Remove every entry from the cache."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if fnmatch.fnmatch(name, '*.npy') or fnmatch.fnmatch(name, '*.json'):
+            os.remove(os.path.join(cache_dir, name))
+
+
+#-----------------------
+# Interpolation results
+#-----------------------
+def content_hash(data_file, cache_dir=None):
+    """
+    Return the sha1 of a data file's contents (combined over all the files it's
+    read from), taken from its parsed data cache record when that is current.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    if is_current(data_file, cache_dir):
+        record = _read_record(_entry_paths(data_file, cache_dir)[1])
+        if record is not None:
+            return record['sha1']
+    return _combined_hash([_source_record(source) for source in ismip_parse.sources(data_file)])
+
+
+def _fields_paths(data_file, spec, cache_dir):
+    key = json.dumps([content_hash(data_file, cache_dir), spec], sort_keys=True)
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    fields_dir = os.path.join(cache_dir, 'interp')
+    return (os.path.join(fields_dir, key+'.npz'), os.path.join(fields_dir, key+'.json'))
+
+
+def load_fields(data_file, spec, cache_dir=None):
+    """
+    Return the cached dict of interpolated fields for a data file and
+    interpolation spec (a json-able dict of e.g. grid size, method and code
+    version), or None if they aren't cached.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    fields_file, record_file = _fields_paths(data_file, spec, cache_dir)
+    if not os.path.isfile(fields_file):
+        return None
+    try:
+        with numpy.load(fields_file) as npz:
+            fields = dict((name, npz[name]) for name in npz.files)
+    except (IOError, OSError, ValueError):
+        return None
+
+    # the mtime marks when an entry was last used, for eviction
+    try:
+        os.utime(fields_file, None)
+    except OSError:
+        pass
+    return fields
+
+
+def store_fields(data_file, spec, fields, cache_dir=None):
+    """Store a dict of interpolated fields for a data file and interpolation spec."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    fields_file, record_file = _fields_paths(data_file, spec, cache_dir)
+    mkdir_p(os.path.dirname(fields_file))
+
+    record = {'source': os.path.abspath(data_file),
+              'spec': spec,
+              'fields': sorted(fields),
+             }
+    try:
+        _write_atomic(fields_file, lambda f: numpy.savez(f, **fields))
+        _write_atomic(record_file, lambda f: f.write(json.dumps(record).encode('utf-8')))
+    except (IOError, OSError):
+        pass # a read-only cache shouldn't stop us from using the results
+
+
+def fields_info(cache_dir=None):
+    """
+    Return a record for each cached set of interpolated fields, least recently
+    used first. Each record has the source file, spec, field names, size in
+    bytes and last used time of the entry.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    fields_dir = os.path.join(cache_dir, 'interp')
+    if not os.path.isdir(fields_dir):
+        return []
+
+    entries = []
+    for name in fnmatch.filter(os.listdir(fields_dir), '*.npz'):
+        fields_file = os.path.join(fields_dir, name)
+        record_file = os.path.splitext(fields_file)[0]+'.json'
+        record = _read_record(record_file) or {}
+        try:
+            stat = os.stat(fields_file)
+        except OSError:
+            continue
+        record['file'] = fields_file
+        record['bytes'] = stat.st_size
+        record['last_used'] = stat.st_mtime
+        entries.append(record)
+    return sorted(entries, key=lambda r: r['last_used'])
+
+
+def evict_fields(max_bytes, cache_dir=None):
+    """
+    Evict the least recently used interpolated fields until the cache holds at
+    most max_bytes of them. Returns the number of entries evicted.
+    """
+    entries = fields_info(cache_dir)
+    total = sum(r['bytes'] for r in entries)
+    evicted = 0
+    for record in entries:
+        if total <= max_bytes:
+            break
+        for path in [record['file'], os.path.splitext(record['file'])[0]+'.json']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= record['bytes']
+        evicted += 1
+    return evicted
+
+
+def clear_fields(cache_dir=None):
+    """Remove every set of interpolated fields from the cache."""
+    return evict_fields(0, cache_dir)
+
+
+#---------------------
+# Ensemble statistics
+#---------------------
+def _ensemble_path(inputs, cache_dir):
+    key = hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'ensemble', key+'.npz')
+
+
+def load_ensemble(inputs, cache_dir=None):
+    """
+    Return the cached dict of arrays computed from inputs (a json-able
+    description of e.g. the member files' content hashes and the settings used),
+    or None if they aren't cached.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    ensemble_file = _ensemble_path(inputs, cache_dir)
+    if not os.path.isfile(ensemble_file):
+        return None
+    try:
+        with numpy.load(ensemble_file) as npz:
+            return dict((name, npz[name]) for name in npz.files)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def store_ensemble(inputs, arrays, cache_dir=None):
+    """Store a dict of arrays computed from inputs."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    ensemble_file = _ensemble_path(inputs, cache_dir)
+    mkdir_p(os.path.dirname(ensemble_file))
+    try:
+        _write_atomic(ensemble_file, lambda f: numpy.savez(f, **arrays))
+    except (IOError, OSError):
+        pass # a read-only cache shouldn't stop us from using the results
+
+
+def clear_ensembles(cache_dir=None):
+    """Remove every set of ensemble statistics from the cache."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    ensemble_dir = os.path.join(cache_dir, 'ensemble')
+    if os.path.isdir(ensemble_dir):
+        shutil.rmtree(ensemble_dir)
+
+
+#-------------
+# Submissions
+#-------------
+def store_submission(name, content, cache_dir=None):
+    """
+    Store the content of a submitted data file, named like NNNMELLL.txt, and
+    return its path. The same content is stored at the same path, so its parsed
+    data and interpolated fields are cached like any other data file.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    submission_dir = os.path.join(cache_dir, 'submissions', hashlib.sha1(content).hexdigest())
+    data_file = os.path.join(submission_dir, os.path.basename(name))
+    if not os.path.isfile(data_file):
+        mkdir_p(submission_dir)
+        _write_atomic(data_file, lambda f: f.write(content))
+    else:
+        os.utime(submission_dir, None) # most recently used
+    return data_file
+
+
+def remove_submission(data_file, cache_dir=None):
+    """Remove a submitted data file, and its parsed data, from the cache."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    for path in _entry_paths(data_file, cache_dir):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    shutil.rmtree(os.path.dirname(data_file), ignore_errors=True)
+
+
+def evict_submissions(max_count, cache_dir=None):
+    """
+    Remove the least recently submitted data files until at most max_count are
+    kept. Returns the number removed.
+    """
+    if cache_dir is None:
+        cache_dir = cache_path
+    submissions_dir = os.path.join(cache_dir, 'submissions')
+    if not os.path.isdir(submissions_dir):
+        return 0
+    submissions = []
+    for digest in os.listdir(submissions_dir):
+        submission_dir = os.path.join(submissions_dir, digest)
+        try:
+            submissions.append((os.stat(submission_dir).st_mtime, submission_dir))
+        except OSError:
+            pass
+    submissions.sort()
+    evicted = 0
+    for mtime, submission_dir in submissions[:max(0, len(submissions)-max_count)]:
+        for name in os.listdir(submission_dir):
+            remove_submission(os.path.join(submission_dir, name), cache_dir)
+        shutil.rmtree(submission_dir, ignore_errors=True)
+        evicted += 1
+    return evicted
+
+
+def clear_submissions(cache_dir=None):
+    """Remove every submitted data file from the cache."""
+    if cache_dir is None:
+        cache_dir = cache_path
+    submission_dir = os.path.join(cache_dir, 'submissions')
+    if os.path.isdir(submission_dir):
+        shutil.rmtree(submission_dir)
+
+
+#------------
+# Memory cap
+#------------
+class field_store(object):
+    """
+    Keeps track of the bytes of the arrays held in memory, and once holding
+    another would go over a cap, spills it to a memory-mapped file instead.
+
+    Held arrays are counted until they're garbage collected. Spill files are
+    written to a scratch directory (under the cache directory by default) which
+    is removed at exit.
+    """
+    def __init__(self):
+        self.held = 0
+        self.spilled = 0
+        self.spill_dir = None
+        self._refs = {}
+
+    def hold(self, array, max_bytes=None, spill_dir=None):
+        """
+        Return the array to keep: the array itself if it fits under max_bytes
+        (None for no cap), otherwise a read-only memory-mapped copy of it.
+        """
+        if max_bytes is None or self.held + array.nbytes <= max_bytes:
+            self.held += array.nbytes
+            ref = weakref.ref(array, self._release)
+            self._refs[id(ref)] = (ref, array.nbytes)
+            return array
+        return self.spill(array, spill_dir)
+
+    def _release(self, ref):
+        self.held -= self._refs.pop(id(ref), (ref, 0))[1]
+
+    def spill(self, array, spill_dir=None):
+        """Write an array to a spill file and return it memory-mapped, read-only."""
+        if self.spill_dir is None:
+            if spill_dir is None:
+                spill_dir = os.path.join(cache_path, 'spill')
+            mkdir_p(spill_dir)
+            self.spill_dir = tempfile.mkdtemp(prefix='spill_', dir=spill_dir)
+            atexit.register(self.close)
+
+        fd, path = tempfile.mkstemp(dir=self.spill_dir, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        self.spilled += array.nbytes
+        return numpy.load(path, mmap_mode='r')
+
+    def close(self):
+        """Remove the spill files. Arrays spilled to them must not be used after."""
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self.spilled = 0
+
+
+def timing(data_files, cache_dir=None):
+    """
+    Time loading the data files without the cache, with a cold cache and with a
+    warm cache. Returns a dict of wall-clock seconds for each.
+    """
+    remove = cache_dir is None
+    if cache_dir is None:
+        cache_dir = tempfile.mkdtemp(prefix='ismip_cache_')
+    else:
+        clear(cache_dir)
+
+    times = {}
+    try:
+        start = time.time()
+        for df in data_files:
+            ismip_parse.load(df)
+        times['parse'] = time.time() - start
+
+        start = time.time()
+        for df in data_files:
+            load(df, cache_dir=cache_dir)
+        times['cold'] = time.time() - start
+
+        start = time.time()
+        for df in data_files:
+            load(df, cache_dir=cache_dir)
+        times['warm'] = time.time() - start
+    finally:
+        if remove:
+            shutil.rmtree(cache_dir)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time, inspect or clear the ISMIP-HOM data cache.')
+    parser.add_argument('ismip_data', nargs='?', default='./ismip_all',
+                        help='Location of the ISMIP-HOM data to time loading.')
+    parser.add_argument('--cache-dir', default=cache_path, help='Location of the cache.')
+    parser.add_argument('--info', action='store_true', help='List the cached interpolation results.')
+    parser.add_argument('--clear', action='store_true', help='Remove everything from the cache.')
+    args = parser.parse_args()
+
+    if args.info:
+        entries = fields_info(args.cache_dir)
+        for record in entries:
+            print("{:<40s} {:>9d} B  last used {}".format(
+                  os.path.basename(record.get('source', '?')), record['bytes'],
+                  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['last_used']))))
+        print(str(len(entries))+" interpolation results, {:.1f} MB".format(
+              sum(r['bytes'] for r in entries)/2.0**20))
+        sys.exit()
+
+    if args.clear:
+        clear_ensembles(args.cache_dir)
+        clear_submissions(args.cache_dir)
+        clear_fields(args.cache_dir)
+        clear(args.cache_dir)
+        sys.exit()
+
+    data_files = []
+    for base, dirs, files in os.walk(args.ismip_data):
+        data_files.extend(os.path.join(base, f) for f in fnmatch.filter(files, '*.txt'))
+    data_files = ismip_parse.data_files(data_files)
+
+    times = timing(data_files)
+    print("Loaded "+str(len(data_files))+" files from "+args.ismip_data)
+    print("    no cache:      {:8.3f} s".format(times['parse']))
+    print("    cold cache:    {:8.3f} s".format(times['cold']))
+    print("    warm cache:    {:8.3f} s  ({:.1f}x faster than no cache)".format(
+          times['warm'], times['parse']/times['warm']))
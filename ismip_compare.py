@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Compare new model results to the ISMIP-HOM ensembles.
+
+Only the new data files are loaded and interpolated. Their figure lines are
+compared to the full-Stokes and higher-order ensemble statistics written out
+with the figures (see recreate.figure_stats), which are kept in the ensemble
+cache, so a new submission can be scored without rebuilding everything.
+
+The data files need to follow the ISMIP-HOM data standards, including the
+NNNMELLL.txt file names (e.g. cis1a005.txt: model cis1, Exp. A, L = 5 km).
+For example:
+
+    python ismip_compare.py cis1a005.txt cis1a010.txt --out cis1a.csv
+
+To find the outliers among the ISMIP-HOM models themselves, the distances
+between every pair of models, and each model's deviation from the full-Stokes
+and higher-order ensembles without it, can be written out for each figure and
+length; e.g., along the figure lines of Exp. A and C, or over the whole grid:
+
+    python ismip_compare.py --scores a c --out-dir scores/ [--grid]
+
+These are cached per experiment and length, so adding a model only recomputes
+the scores for its length.
+"""
+
+
+import os
+import numpy
+import argparse
+
+import recreate
+import ismip_build
+import ismip_cache
+import ismip_stats
+
+
+# The deviation metrics reported (see ismip_stats.deviation)
+metrics = ['rmse', 'max_abs', 'rel_rmse', 'mean_z', 'inside']
+
+
+def check_name(data_file):
+    """
+    Return the (model, experiment, length) a data file is named for, or raise a
+    ValueError if it isn't named like NNNMELLL.txt for the experiment and
+    length of one of the figures (see recreate.figure_stats).
+    """
+    name = os.path.basename(data_file)
+    if len(os.path.splitext(name)[0].split('_')[0]) != 8:
+        raise ValueError(name+": data files need to be named like NNNMELLL.txt, e.g. cis1a010.txt")
+    model, exp, length = recreate.ismip_datum.parse_file(data_file)
+    lengths = sorted(set(l for figure, figure_exp, figure_lengths, axis_name, field in recreate.figure_stats
+                         if figure_exp == exp for l in figure_lengths))
+    if not lengths:
+        raise ValueError("{}: names model '{}', Exp. '{}'; only Exp. A, C and F are compared "
+                         "(data files need to be named like NNNMELLL.txt, e.g. cis1a010.txt)".format(
+                         name, model, exp.upper()))
+    if length not in lengths:
+        raise ValueError("{}: Exp. {} has no length '{}'; choose from {}".format(
+                         name, exp.upper(), length, ', '.join(lengths)))
+    return model, exp, length
+
+
+def compare(data_files, catalog=None, ensembles=None):
+    """
+    Compare each data file to the ensembles for its experiment and length. The
+    ensemble statistics are kept in ensembles, a dict by figure name, which can
+    be passed in to reuse them across calls. Data files that aren't named for
+    the experiment and length of a figure are an error (see check_name).
+
+    Returns a list of records, one per data file, figure and model order, with
+    the data file, model, figure name, length, order and the deviation metrics
+    of the file's figure line from that order's ensemble.
+    """
+    for data_file in data_files:
+        check_name(data_file)
+    if catalog is None:
+        catalog = recreate.ismip_catalog(recreate.ismip_data, os.path.join(recreate.cache_path, 'catalog.json'))
+
+    if ensembles is None:
+        ensembles = {}
+    records = []
+    for data_file in data_files:
+        datum = recreate.ismip_datum(data_file)
+        # load the data even if the model isn't one of the ISMIP-HOM models
+        datum.array = ismip_cache.load(data_file, cache_dir=recreate.cache_path)
+
+        for name, exp, lengths, axis_name, field in recreate.figure_stats:
+            if exp != datum.E or datum.L not in lengths:
+                continue
+            if name not in ensembles:
+                ensembles[name] = recreate.cached_ensemble(catalog, exp, field)
+            line = recreate.figure_line(datum, field)
+
+            for order in ['full_stokes', 'higher_order']:
+                stats = ensembles[name].get((order, datum.L))
+                if stats is None:
+                    continue
+                record = {'file': data_file, 'model': datum.M, 'figure': name,
+                          'length': datum.L, 'order': order}
+                record.update(ismip_stats.deviation(line, stats))
+                records.append(record)
+    return records
+
+
+def ensemble_scores(catalog, exp, field, length, grid=False):
+    """
+    Score the ISMIP-HOM models of an experiment and length against each other,
+    along the figure line of a field (see recreate.figure_line), or over the
+    whole grid if grid is true. Returns a dict of arrays:
+        models, orders     -- each model's name and order
+        rmse, max_abs      -- the distances between each pair of models (see
+                              ismip_stats.distances)
+        <order>_<metric>   -- the deviation metrics of each model from each
+                              order's ensemble, leaving the model out of its
+                              own ensemble (see ismip_stats.leave_one_out)
+    The scores are cached.
+    """
+    recreate.check_field(exp, field)
+    datums = catalog.query(order=['full_stokes','higher_order'], exp=exp, length=length)
+    inputs = dict(recreate.ensemble_inputs(datums, exp, field), stats='scores', grid=bool(grid),
+                  scores_code=ismip_build.source_hash([__name__]))
+    scores = ismip_cache.load_ensemble(inputs, cache_dir=recreate.cache_path)
+    if scores is not None:
+        return scores
+
+    if len(datums) < 2:
+        raise ValueError("There are {} models of Exp. {} with length {}; at least 2 are needed to score them".format(
+                         len(datums), exp.upper(), length))
+
+    recreate.interp_all(datums, recreate.workers)
+    if grid:
+        lines = numpy.array([getattr(d, field).ravel() for d in datums])
+    else:
+        lines = numpy.array([recreate.figure_line(d, field) for d in datums])
+    orders = numpy.array([d.order for d in datums])
+
+    scores = {'models': numpy.array([d.M for d in datums]), 'orders': orders}
+    distances = ismip_stats.distances(lines)
+    scores['rmse'] = distances['rmse']
+    scores['max_abs'] = distances['max_abs']
+    for order in ['full_stokes', 'higher_order']:
+        for metric, values in ismip_stats.leave_one_out(lines, orders == order).items():
+            scores[order+'_'+metric] = values
+    ismip_cache.store_ensemble(inputs, scores, cache_dir=recreate.cache_path)
+    return scores
+
+
+def write_distances(out_file, scores, distance='rmse'):
+    """Write the matrix of distances between the models to a comma separated text file."""
+    with open(out_file, 'w') as f:
+        f.write('# model,order,'+','.join(scores['models'])+'\n')
+        for model, order, row in zip(scores['models'], scores['orders'], scores[distance]):
+            f.write(model+','+order+','+','.join('{:.6e}'.format(v) for v in row)+'\n')
+
+
+def write_scores(out_file, scores):
+    """
+    Write each model's deviations from the full-Stokes and higher-order
+    ensembles to a comma separated text file; scores is a dict of ensemble_scores
+    keyed by length.
+    """
+    columns = ['length', 'model', 'order', 'ensemble'] + metrics
+    with open(out_file, 'w') as f:
+        f.write('# '+','.join(columns)+'\n')
+        for length in sorted(scores):
+            for i, model in enumerate(scores[length]['models']):
+                for ensemble in ['full_stokes', 'higher_order']:
+                    f.write(','.join([length, model, scores[length]['orders'][i], ensemble]) + ',' +
+                            ','.join('{:.6e}'.format(scores[length][ensemble+'_'+m][i]) for m in metrics) + '\n')
+
+
+def export_scores(catalog, exps, out_dir, grid=False):
+    """
+    Write the distance matrices and leave-one-out scores of the models for each
+    figure of the experiments (see recreate.figure_stats) to out_dir, as
+    <figure>_<length>_distances.csv and <figure>_scores.csv (with _grid before
+    the extension for scores over the whole grid). Returns the files written.
+    """
+    recreate.mkdir_p(out_dir)
+    suffix = '_grid' if grid else ''
+    written = []
+    for name, exp, lengths, axis_name, field in recreate.figure_stats:
+        if exp not in exps:
+            continue
+        scores = {}
+        for length in lengths:
+            if catalog.query(order=['full_stokes','higher_order'], exp=exp, length=length):
+                scores[length] = ensemble_scores(catalog, exp, field, length, grid)
+        for length, length_scores in sorted(scores.items()):
+            out_file = os.path.join(out_dir, '{}_{}_distances{}.csv'.format(name, length, suffix))
+            write_distances(out_file, length_scores)
+            written.append(out_file)
+        out_file = os.path.join(out_dir, '{}_scores{}.csv'.format(name, suffix))
+        write_scores(out_file, scores)
+        written.append(out_file)
+    return written
+
+
+def write_report(out_file, records):
+    """Write the comparison records to a comma separated text file."""
+    columns = ['file', 'model', 'figure', 'length', 'order'] + metrics
+    with open(out_file, 'w') as f:
+        f.write('# '+','.join(columns)+'\n')
+        for record in records:
+            f.write(','.join(str(record[c]) for c in columns[:5]) + ',' +
+                    ','.join('{:.6e}'.format(record[m]) for m in metrics) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare new model results to the ISMIP-HOM ensembles.')
+    parser.add_argument('data_files', nargs='*', help='The new data files, named like NNNMELLL.txt.')
+    parser.add_argument('--ismip-data', default=recreate.ismip_data,
+                        help='Location of the ISMIP-HOM data.')
+    parser.add_argument('--cache-dir', default=recreate.cache_path, help='Location of the cache.')
+    parser.add_argument('--out', help='Also write the comparison to this file.')
+    parser.add_argument('--scores', nargs='+', metavar='EXP', choices=['a','c','f'],
+                        help='Write the distances between the ISMIP-HOM models and their '
+                             'leave-one-out scores for these experiments.')
+    parser.add_argument('--grid', action='store_true',
+                        help='Score the models over the whole grid rather than along the figure lines.')
+    parser.add_argument('--out-dir', default='.', help='Where to write the --scores files.')
+    args = parser.parse_args()
+    if not args.data_files and not args.scores:
+        parser.error('give data files to compare and/or --scores')
+
+    recreate.ismip_data = args.ismip_data
+    recreate.cache_path = args.cache_dir
+
+    if args.scores:
+        catalog = recreate.ismip_catalog(recreate.ismip_data, os.path.join(recreate.cache_path, 'catalog.json'))
+        for out_file in export_scores(catalog, args.scores, args.out_dir, args.grid):
+            print("Wrote "+out_file)
+
+    if args.data_files:
+        try:
+            records = compare(args.data_files)
+        except ValueError as e:
+            parser.error(str(e))
+        compared = set(r['file'] for r in records)
+        for data_file in args.data_files:
+            if data_file not in compared:
+                print("Skipping "+data_file+": there's no ensemble for its experiment and length.")
+
+        print("{:<14s} {:<10s} {:>6s} {:<12s} {:>10s} {:>10s} {:>9s} {:>7s} {:>7s}".format(
+              'file', 'figure', 'length', 'order', 'rmse', 'max abs', 'rel rmse', 'mean z', 'inside'))
+        for r in records:
+            print("{:<14s} {:<10s} {:>6s} {:<12s} {:10.4g} {:10.4g} {:9.2%} {:7.2f} {:7.1%}".format(
+                  os.path.basename(r['file']), r['figure'], r['length'], r['order'],
+                  r['rmse'], r['max_abs'], r['rel_rmse'], r['mean_z'], r['inside']))
+
+        if args.out:
+            write_report(args.out, records)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Interpolation of the ISMIP-HOM data onto regular x_hat/y_hat grids.
+
+The data are linearly interpolated over a Delaunay triangulation of the
+points, like scipy.interpolate.griddata(method='linear'), which the published
+figures were made with. Most submissions report their results on a
+rectilinear x/y lattice; setting `structured` interpolates those with a
+(bilinear) rectilinear interpolator instead, which is faster on the larger
+lattices, but doesn't reproduce griddata.
+
+NOTE: On a lattice every cell is cocircular, so the Delaunay triangulation may
+      split each cell along either diagonal and griddata's result depends on
+      which one qhull happened to pick. The bilinear result doesn't; it
+      differs from griddata by up to ~4% of a field's largest value on the
+      coarsest 13x13 and 21x21 submissions (e.g. yko1a*, cma2c160), and moves
+      the ensemble statistics by up to 0.25% of their range, or 1.1% of a
+      value (the ExpC_Fig8 L=160 full-Stokes std).
+
+Run this module directly to benchmark the rectilinear path against griddata on
+each data file:
+
+    python ismip_interp.py [ismip_data]
+"""
+
+
+import os
+import sys
+import time
+import numpy
+import fnmatch
+import hashlib
+import threading
+import collections
+
+import ismip_profile
+
+#NOTE: scipy is slow to import, so it's imported where it's used.
+
+
+# Use the rectilinear interpolator for data on a lattice (off: the results then
+# match griddata, and the published figures)
+structured = False
+
+def method():
+    """Return a name for the interpolation method in use."""
+    return 'linear+rectilinear' if structured else 'linear'
+
+
+# Delaunay triangulations keyed by a hash of the points they were built from.
+# Many models report their results on the same x_hat/y_hat layout, so a
+# triangulation is built once and shared between all those data files. Only
+# the triangulation_cache_size most recently used are kept, so a long-running
+# process (see ismip_serve) doesn't keep one for every file it's given.
+triangulation_cache_size = 16
+_triangulations = collections.OrderedDict()
+_triangulations_lock = threading.Lock()
+
+def triangulate(points):
+    """
+    Return the Delaunay triangulation of points, reusing the one built for an
+    identical set of points if there is one.
+    """
+    points = numpy.ascontiguousarray(points, dtype=numpy.float64)
+    key = (points.shape, hashlib.sha1(points.tobytes()).hexdigest())
+    with _triangulations_lock:
+        tri = _triangulations.pop(key, None)
+    if tri is None:
+        with ismip_profile.stage('triangulate', points=len(points)):
+            import scipy.spatial
+            tri = scipy.spatial.Delaunay(points)
+    with _triangulations_lock:
+        _triangulations[key] = tri
+        while len(_triangulations) > triangulation_cache_size:
+            _triangulations.popitem(last=False)
+    return tri
+
+
+def normalize_xy(xy):
+    """
+    Some of the Exp. F data is reported in the scaled coordinate system (x_hat),
+    and others is reported in the cartesian coordinate system (x). This
+    normalizes the coordinate systems.
+    """
+    if xy[0,0] < -1.0:
+        xy = xy/100.0 + 0.5
+    return xy
+
+
+def rectilinear_axes(points):
+    """
+    Check whether points lie on a rectilinear lattice, with every x/y
+    combination appearing exactly once.
+
+    Returns the sorted (x, y) axes and the (ix, iy) lattice index of each point,
+    or None if the points are scattered.
+    """
+    x = numpy.unique(points[:,0])
+    y = numpy.unique(points[:,1])
+    if x.size < 2 or y.size < 2 or x.size*y.size != points.shape[0]:
+        return None
+
+    ix = numpy.searchsorted(x, points[:,0])
+    iy = numpy.searchsorted(y, points[:,1])
+    if numpy.unique(iy*x.size + ix).size != points.shape[0]:
+        return None
+    return x, y, ix, iy
+
+
+def interp_scattered(points, values, xi):
+    """Linearly interpolate scattered values onto the (x, y) grids in xi."""
+    import scipy.interpolate
+    interp = scipy.interpolate.LinearNDInterpolator(triangulate(points), values)
+    return interp(xi)
+
+
+def interp_rectilinear(axes, values, xi):
+    """Bilinearly interpolate values on the lattice described by axes onto the (x, y) grids in xi."""
+    x, y, ix, iy = axes
+    lattice = numpy.empty((y.size, x.size, values.shape[1]))
+    lattice[iy, ix] = values
+    import scipy.interpolate
+    interp = scipy.interpolate.RegularGridInterpolator((y, x), lattice, method='linear', 
+                                                       bounds_error=False, fill_value=numpy.nan)
+    return interp(numpy.stack((xi[1], xi[0]), axis=-1))
+
+
+def interpolate(points, values, xi, structured=None):
+    """
+    Interpolate each column of values, given at points, onto the (x, y) grids
+    in xi. Returns an array of shape xi[0].shape + (number of columns,).
+
+    If structured is set (default: the module setting) and points lie on a
+    rectilinear lattice, the fast rectilinear path is used; otherwise the data
+    is treated as scattered.
+    """
+    if structured is None:
+        structured = globals()['structured']
+    values = numpy.asarray(values, dtype=numpy.float64)
+    axes = rectilinear_axes(points) if structured else None
+    if axes is None:
+        return interp_scattered(points, values, xi)
+    return interp_rectilinear(axes, values, xi)
+
+
+def benchmark(data_files, points_p_quarter=25):
+    """
+    Time griddata against interpolate for each Exp. A, C and F data file.
+
+    Returns a list of (data file, number of points, layout, griddata seconds,
+    interpolate seconds, max. relative difference) tuples.
+    """
+    import scipy.interpolate
+    x_hat = numpy.linspace(0.0, 1.0, points_p_quarter*4+1)
+    xi = numpy.meshgrid(x_hat, x_hat)
+
+    results = []
+    for df in data_files:
+        code_name = str.lower(os.path.basename(os.path.splitext(df)[0]))
+        if code_name[4] not in ['a','c','f'] or len(code_name) != 8:
+            continue
+        array = numpy.loadtxt(df)
+        points = normalize_xy(array[:,0:2])
+        values = array[:,2:4]
+
+        start = time.time()
+        ref = scipy.interpolate.griddata(points, values, tuple(xi), method='linear')
+        t_ref = time.time() - start
+
+        _triangulations.clear()
+        start = time.time()
+        new = interpolate(points, values, xi, structured=True)
+        t_new = time.time() - start
+
+        with numpy.errstate(invalid='ignore'):
+            scale = numpy.nanmax(numpy.abs(ref)) if numpy.isfinite(ref).any() else 1.0
+            diff = numpy.nanmax(numpy.abs(new - ref))/scale if numpy.isfinite(new - ref).any() else 0.0
+        layout = 'rectilinear' if rectilinear_axes(points) is not None else 'scattered'
+        results.append((df, points.shape[0], layout, t_ref, t_new, diff))
+    return results
+
+
+if __name__ == '__main__':
+    ismip_data = sys.argv[1] if len(sys.argv) > 1 else './ismip_all'
+
+    data_files = []
+    for base, dirs, files in os.walk(ismip_data):
+        data_files.extend(os.path.join(base, f) for f in fnmatch.filter(files, '*.txt'))
+
+    results = benchmark(sorted(data_files))
+    print("{:<14s} {:>7s} {:<12s} {:>10s} {:>10s} {:>8s} {:>9s}".format(
+          'file', 'points', 'layout', 'griddata', 'fast', 'speedup', 'max diff'))
+    for df, n, layout, t_ref, t_new, diff in results:
+        print("{:<14s} {:7d} {:<12s} {:8.2f}ms {:8.2f}ms {:7.1f}x {:9.2e}".format(
+              os.path.basename(df), n, layout, t_ref*1e3, t_new*1e3, t_ref/t_new, diff))
+
+    t_ref = sum(r[3] for r in results)
+    t_new = sum(r[4] for r in results)
+    print("total: griddata {:.2f} s, fast {:.2f} s ({:.1f}x)".format(t_ref, t_new, t_ref/t_new))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Parsing of the ISMIP-HOM data files.
+
+Each file is read into memory whole and converted to numbers in a single bulk
+pass, rather than line by line. Layouts that don't conform to the one file per
+experiment standard are normalized by adapters into the columns given in
+`header`.
+
+Parsing holds the GIL, so it isn't parallelized with threads here; in the
+pipeline, each file is parsed in the worker process that interpolates it (see
+recreate.interp_all), so parsing runs in parallel across files there.
+
+Run this module directly to time parsing the data against numpy.loadtxt:
+
+    python ismip_parse.py [ismip_data]
+"""
+
+
+import os
+import sys
+import time
+import numpy
+import fnmatch
+import warnings
+
+
+# The ISMIP-HOM data file headers for each experiment.
+header = {'a':['x_hat','y_hat','vx_surf','vy_surf','tau_xz','tau_yz','del_p'],
+          'b':['x_hat','vx_surf','vz_surf','tau_xz','del_p'],
+          'c':['x_hat','y_hat','vx_surf','vy_surf','vz_surf','vx_base', 'vy_base','tau_xz','tau_yz','del_p'],
+          'd':['x_hat','vx_surf','vz_surf','vx_base','tau_xz','del_p'],
+          'e':['x_hat','vx_surf','vz_surf','tau_xz','del_p'],
+          'f':['x_hat','y_hat','z_surf','vx','vy','vz'],
+         }
+
+
+#NOTE: From numpy 1.23, numpy.loadtxt has a C reader, which is fastest when
+#      given the lines of the whole file at once. Before that it's pure Python,
+#      and a single numpy.fromstring pass over the whole file is much faster.
+_c_loadtxt = numpy.lib.NumpyVersion(numpy.__version__) >= '1.23.0'
+
+
+def parse(data_file):
+    """
+    Parse a whitespace delimited text file of numbers into a 2D array, with a
+    row per line. Any line endings (\n, \r\n or \r) are accepted, as are
+    Fortran style numbers like -.25761204E+01 or 0.0000000e+000.
+    """
+    with open(data_file, 'rb') as f:
+        text = f.read().decode('ascii')
+    lines = text.splitlines()
+    if _c_loadtxt:
+        return numpy.loadtxt(lines, ndmin=2)
+
+    columns = len(lines[0].split()) if lines else 0
+    try:
+        with warnings.catch_warnings():
+            # older numpy only warns when it can't parse all of the text
+            warnings.simplefilter('error', DeprecationWarning)
+            values = numpy.fromstring(text, dtype=numpy.float64, sep=' ')
+    except (ValueError, DeprecationWarning):
+        values = None
+
+    if not columns or values is None or values.size % columns:
+        # not a plain table of numbers; let loadtxt sort it out (or explain why not)
+        return numpy.loadtxt(lines, ndmin=2)
+    return values.reshape(-1, columns)
+
+
+#----------
+# Adapters
+#----------
+#NOTE: Some models (e.g. aas1) report the surface and basal results for the
+#      flowline experiments (B, D and E) in separate NNNMELLL_surf.txt and
+#      NNNMELLL_base.txt files, each with x_hat and two columns, and on their
+#      own set of x_hat points. The basal columns are taken to be the same as
+#      in the standard Exp. B and E files; Exp. D files don't report vx_base.
+split_columns = {'surf': ['vx_surf','vz_surf'],
+                 'base': ['tau_xz','del_p'],
+                }
+
+
+def _split_root(data_file):
+    """Return (root, part, ext) if data_file is part of a split layout, otherwise None."""
+    root, ext = os.path.splitext(data_file)
+    for part in split_columns:
+        if root.endswith('_'+part):
+            return (root[:-len(part)-1], part, ext)
+    return None
+
+
+def sources(data_file):
+    """
+    Return the files the data for data_file is read from; for a split layout
+    the _surf file stands for both the _surf and _base files.
+    """
+    split = _split_root(data_file)
+    if split is None or split[1] != 'surf':
+        return [data_file]
+    root, part, ext = split
+    base_file = root+'_base'+ext
+    if not os.path.isfile(base_file):
+        return [data_file]
+    return [data_file, base_file]
+
+
+def is_companion(data_file):
+    """Check whether data_file is read as part of another file's data (e.g. a _base file)."""
+    split = _split_root(data_file)
+    if split is None or split[1] == 'surf':
+        return False
+    root, part, ext = split
+    return os.path.isfile(root+'_surf'+ext)
+
+
+def data_files(files):
+    """Return the files that hold a datum each, dropping companions of split layouts."""
+    return [f for f in files if not is_companion(f)]
+
+
+def merge_split(exp, parts):
+    """
+    Merge the arrays of a split layout (a dict of part name -> array) into the
+    standard columns for the experiment. The parts are linearly interpolated
+    onto the union of their x_hat points; columns none of the parts report are
+    filled with NaN.
+    """
+    if exp not in ['b','d','e']:
+        raise ValueError("Split layouts are only known for the flowline experiments (B, D and E).")
+    x_hat = numpy.unique(numpy.concatenate([array[:,0] for array in parts.values()]))
+
+    merged = numpy.full((x_hat.size, len(header[exp])), numpy.nan)
+    merged[:,0] = x_hat
+    for part, array in parts.items():
+        order = numpy.argsort(array[:,0], kind='mergesort')
+        for i, name in enumerate(split_columns[part]):
+            if name in header[exp]:
+                merged[:,header[exp].index(name)] = numpy.interp(x_hat, array[order,0], array[order,i+1])
+    return merged
+
+
+def load(data_file):
+    """
+    Load a data file into an array with the standard columns for its
+    experiment, adapting nonconforming layouts.
+    """
+    files = sources(data_file)
+    if len(files) == 1:
+        return parse(data_file)
+
+    exp = str.lower(os.path.basename(data_file))[4]
+    parts = {}
+    for f in files:
+        parts[_split_root(f)[1]] = parse(f)
+    return merge_split(exp, parts)
+
+
+if __name__ == '__main__':
+    ismip_data = sys.argv[1] if len(sys.argv) > 1 else './ismip_all'
+
+    all_files = []
+    for base, dirs, files in os.walk(ismip_data):
+        all_files.extend(os.path.join(base, f) for f in fnmatch.filter(files, '*.txt'))
+    all_files.sort()
+    datum_files = data_files(all_files)
+
+    start = time.time()
+    for df in all_files:
+        numpy.loadtxt(df)
+    t_loadtxt = time.time() - start
+
+    start = time.time()
+    for df in datum_files:
+        load(df)
+    t_serial = time.time() - start
+
+    adapted = [df for df in datum_files if len(sources(df)) > 1]
+    print("Parsed "+str(len(all_files))+" files ("+str(len(datum_files))+" data sets, "
+          +str(len(adapted))+" adapted) from "+ismip_data)
+    print("    numpy.loadtxt: {:8.3f} s".format(t_loadtxt))
+    print("    ismip_parse:   {:8.3f} s".format(t_serial))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Per-stage profiling of the recreate pipeline.
+
+Code to be profiled is wrapped in a stage:
+
+    with ismip_profile.stage('interpolate', file=data_file, model=model):
+        ...
+
+and, once profiling is enabled, a record of the wall time, CPU time and peak
+(Python traced) memory of each stage is kept, labelled with its keyword
+arguments. Nothing is recorded, and almost no time is spent, while profiling is
+disabled.
+
+Stages may be nested; the outer stage's times and peak memory include the
+inner ones'. Stages run in worker processes are recorded there, and are
+gathered with take() to be added to the main process' records. Their CPU time
+isn't included in the enclosing stage of the main process.
+"""
+
+
+import os
+import csv
+import json
+import time
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+try:
+    process_time = time.process_time
+    wall_time = time.perf_counter
+except AttributeError: # Python 2
+    process_time = time.clock
+    wall_time = time.time
+
+
+enabled = False
+records = []
+
+# The number of open stages, and a stack of their memory usage: [start, highest
+# peak seen]
+_depth = 0
+_memory = []
+
+# The columns of the report, before any labels
+columns = ['stage', 'wall', 'cpu', 'peak_mem', 'depth', 'pid']
+
+
+def enable(trace_memory=True):
+    """
+    Start recording stages. Tracing memory (with tracemalloc) to get the peak
+    memory of each stage slows things down somewhat.
+    """
+    global enabled
+    enabled = True
+    if trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global enabled
+    enabled = False
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def worker_args():
+    """The arguments for init_worker to profile worker processes like this one."""
+    return (enabled, _tracing())
+
+
+def init_worker(profile=False, trace_memory=False):
+    """
+    Set up profiling in a (pool) worker process; records and open stages
+    inherited from the parent process are dropped.
+    """
+    global _depth
+    take()
+    _depth = 0
+    del _memory[:]
+    if profile:
+        enable(trace_memory)
+    else:
+        disable()
+
+
+def take():
+    """Return the records so far, and clear them."""
+    global records
+    taken, records = records, []
+    return taken
+
+
+def _tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+class stage(object):
+    """Record the wall time, CPU time and peak memory of a stage."""
+    __slots__ = ['name', 'labels', 'wall', 'cpu', 'depth']
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        global _depth
+        if not enabled:
+            return self
+        if _tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if _memory:
+                _memory[-1][1] = max(_memory[-1][1], peak)
+            if hasattr(tracemalloc, 'reset_peak'): # Python >= 3.9
+                tracemalloc.reset_peak()
+            _memory.append([current, current])
+        _depth += 1
+        self.depth = _depth
+        self.wall = wall_time()
+        self.cpu = process_time()
+        return self
+
+    def __exit__(self, *exc):
+        global _depth
+        if not enabled or not hasattr(self, 'wall'):
+            return False
+        _depth -= 1
+        record = {'stage': self.name,
+                  'wall': wall_time() - self.wall,
+                  'cpu': process_time() - self.cpu,
+                  'peak_mem': None,
+                  'depth': self.depth,
+                  'pid': os.getpid(),
+                 }
+        if _tracing() and _memory:
+            start, peak = _memory.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if _memory:
+                _memory[-1][1] = max(_memory[-1][1], peak)
+            record['peak_mem'] = peak - start
+        record.update(self.labels)
+        records.append(record)
+        return False
+
+
+def label_names(records):
+    """Return the sorted names of the labels used in records."""
+    return sorted(set(k for r in records for k in r) - set(columns))
+
+
+def write_json(out_file, records):
+    with open(out_file, 'w') as f:
+        json.dump(records, f, indent=1, sort_keys=True)
+
+
+def write_csv(out_file, records):
+    fields = columns + label_names(records)
+    with open(out_file, 'w') as f:
+        writer = csv.DictWriter(f, fields, restval='')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+
+
+def write(out_file, records):
+    """Write the records to a .json or .csv report, by the file's extension."""
+    if os.path.splitext(out_file)[1].lower() == '.csv':
+        write_csv(out_file, records)
+    else:
+        write_json(out_file, records)
+
+
+def summary(records):
+    """
+    Return a summary table (as a string) of the records by stage: the number of
+    times each stage ran, its total and largest wall time, its total CPU time
+    and its largest peak memory.
+    """
+    stages = {}
+    order = []
+    for r in records:
+        if r['stage'] not in stages:
+            stages[r['stage']] = {'count': 0, 'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0, 'peak_mem': None}
+            order.append(r['stage'])
+        s = stages[r['stage']]
+        s['count'] += 1
+        s['wall'] += r['wall']
+        s['max_wall'] = max(s['max_wall'], r['wall'])
+        s['cpu'] += r['cpu']
+        if r['peak_mem'] is not None:
+            s['peak_mem'] = max(s['peak_mem'] or 0, r['peak_mem'])
+
+    lines = ["{:<16s} {:>6s} {:>10s} {:>10s} {:>10s} {:>11s}".format(
+             'stage', 'count', 'wall (s)', 'max (s)', 'cpu (s)', 'peak (MB)')]
+    for name in order:
+        s = stages[name]
+        peak = '-' if s['peak_mem'] is None else '{:.1f}'.format(s['peak_mem']/2.0**20)
+        lines.append("{:<16s} {:6d} {:10.3f} {:10.3f} {:10.3f} {:>11s}".format(
+                     name, s['count'], s['wall'], s['max_wall'], s['cpu'], peak))
+    return '\n'.join(lines)
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+A local service that keeps the ISMIP-HOM ensembles in memory to score new model
+results (e.g. CI runs) without paying the start-up cost each time.
+
+The ensemble is loaded and interpolated once; the interpolated fields and the
+ensemble statistics are then kept warm between requests. Before answering, the
+data directory is checked (at most every reload_interval seconds) and only the
+files that were added, removed or changed are reloaded, along with the
+statistics of their experiments.
+
+It answers HTTP requests on localhost, or on a Unix socket:
+
+    python ismip_serve.py --port 8765 --warm a c f
+    python ismip_serve.py --socket /tmp/ismip.sock
+
+    POST /score?name=cis1a010.txt      the data file as the body; returns its
+                                       deviations from the ensembles (see
+                                       ismip_compare.compare)
+    GET  /envelope?exp=a&length=020    the figure line statistics of each
+                                       ensemble; with &grid=1 (and optionally
+                                       &field=surf_i&percentiles=5,95) those of
+                                       the whole field instead
+    GET  /scores?exp=a&length=020      the distances between the models and
+                                       their leave-one-out scores
+    GET  /status                       what is loaded
+
+for example:
+
+    curl --data-binary @cis1a010.txt 'http://localhost:8765/score?name=cis1a010.txt'
+
+Responses are JSON, with NaN as null. The last submission_cache_size submitted
+files are kept in the cache (see ismip_cache.store_submission), so resubmitting
+a file is answered from the cache; files that can't be scored aren't kept.
+"""
+
+
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+
+import numpy
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError: # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+import recreate
+import ismip_cache
+import ismip_parse
+import ismip_compare
+
+
+# How often to check the data directory for changed files, in seconds
+reload_interval = 1.0
+
+# How many submitted data files to keep in the cache (see ismip_cache.store_submission)
+submission_cache_size = 256
+
+
+def jsonable(value):
+    """Convert numpy results (and dicts and lists of them) to json-able values, with NaN as None."""
+    if isinstance(value, dict):
+        return dict((str(k) if not isinstance(k, tuple) else '/'.join(k), jsonable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, numpy.generic):
+        value = value.item()
+    if isinstance(value, numpy.ndarray):
+        if value.dtype.kind == 'f':
+            finite = numpy.isfinite(value)
+            value = value.astype(object)
+            value[~finite] = None
+        return value.tolist()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+class comparison_service(object):
+    """
+    The ISMIP-HOM ensembles, kept in memory to compare new results against.
+
+    The catalog and the statistics computed from it are shared between
+    requests; a lock keeps them consistent while they're (re)loaded.
+    """
+    def __init__(self, tree=None, cache_dir=None):
+        self.tree = recreate.ismip_data if tree is None else tree
+        self.cache_dir = recreate.cache_path if cache_dir is None else cache_dir
+        self.index_file = os.path.join(self.cache_dir, 'catalog.json')
+        self.lock = threading.RLock()
+
+        self.catalog = recreate.ismip_catalog(self.tree, self.index_file)
+        self.stamps = self.file_stamps(self.catalog.files())
+        self.checked = time.time()
+        self.ensembles = {} # figure name -> ensemble statistics (see recreate.cached_ensemble)
+        self.envelopes = {} # (exp, field, length, percentiles) -> recreate.field_ensemble
+        self.scores = {} # (exp, field, length, grid) -> ismip_compare.ensemble_scores
+
+    @staticmethod
+    def file_stamps(data_files):
+        """The size and mtime of each source of each data file, to tell when they change."""
+        stamps = {}
+        for df in data_files:
+            try:
+                stats = [os.stat(source) for source in ismip_parse.sources(df)]
+                stamps[df] = [(stat.st_size, stat.st_mtime) for stat in stats]
+            except OSError:
+                stamps[df] = None
+        return stamps
+
+    def refresh(self, force=False):
+        """
+        Reload the data files that were added, removed or changed since the last
+        check, and forget the statistics of their experiments. Returns the
+        changed files.
+        """
+        with self.lock:
+            if not force and time.time() - self.checked < reload_interval:
+                return []
+            self.checked = time.time()
+
+            catalog = recreate.ismip_catalog(self.tree, self.index_file)
+            stamps = self.file_stamps(catalog.files())
+            changed = sorted(df for df in set(stamps) | set(self.stamps)
+                             if stamps.get(df) != self.stamps.get(df))
+            if not changed:
+                return []
+
+            # keep the loaded data of the unchanged files
+            for df, datum in self.catalog.datums.items():
+                if df in stamps and df not in changed:
+                    catalog.datums[df] = datum
+            exps = set(recreate.ismip_datum.parse_file(df)[1] for df in changed)
+            self.ensembles = dict((name, stats) for name, stats in self.ensembles.items()
+                                  if self.figure_exp(name) not in exps)
+            self.envelopes = dict((key, value) for key, value in self.envelopes.items() if key[0] not in exps)
+            self.scores = dict((key, value) for key, value in self.scores.items() if key[0] not in exps)
+            self.catalog = catalog
+            self.stamps = stamps
+            return changed
+
+    @staticmethod
+    def figure_exp(name):
+        for figure, exp, lengths, axis_name, field in recreate.figure_stats:
+            if figure == name:
+                return exp
+
+    def warm(self, exps):
+        """Load and interpolate the experiments' data and compute their statistics."""
+        with self.lock:
+            datums = self.catalog.query(order=['full_stokes','higher_order'], exp=exps)
+            recreate.interp_all(datums, recreate.workers)
+            for exp in exps:
+                self.figure_ensembles(exp)
+
+    def figure_ensembles(self, exp):
+        """Return the figure line statistics of an experiment by figure name (see recreate.figure_stats)."""
+        with self.lock:
+            for name, figure_exp, lengths, axis_name, field in recreate.figure_stats:
+                if figure_exp == exp and name not in self.ensembles:
+                    self.ensembles[name] = recreate.cached_ensemble(self.catalog, exp, field)
+            return dict((name, stats) for name, stats in self.ensembles.items()
+                        if self.figure_exp(name) == exp)
+
+    def score(self, name, content):
+        """
+        Compare a submitted data file, named like NNNMELLL.txt, to the ensembles.
+        Returns the comparison records (see ismip_compare.compare); raises a
+        ValueError if the file isn't named for a figure's experiment and length
+        (see ismip_compare.check_name) or there's no ensemble to compare it to.
+        """
+        name = os.path.basename(name)
+        model, exp, length = ismip_compare.check_name(name)
+        data_file = ismip_cache.store_submission(name, content, self.cache_dir)
+
+        self.refresh()
+        with self.lock:
+            catalog = self.catalog
+            ensembles = self.figure_ensembles(exp)
+        # only the submission is loaded here, so other requests can go on
+        try:
+            records = ismip_compare.compare([data_file], catalog, ensembles)
+        except Exception:
+            ismip_cache.remove_submission(data_file, self.cache_dir)
+            raise
+        if not records:
+            ismip_cache.remove_submission(data_file, self.cache_dir)
+            raise ValueError("There's no ensemble of Exp. {} with length {} to compare {} to".format(
+                             exp.upper(), length, name))
+        for record in records:
+            record['file'] = name
+
+        # keep the cache from growing with every submission
+        ismip_cache.evict_submissions(submission_cache_size, self.cache_dir)
+        ismip_cache.evict_fields(recreate.interp_cache_size, self.cache_dir)
+        return records
+
+    def envelope(self, exp, length, grid=False, field='vnorm_surf_i', percentiles=None):
+        """
+        Return the statistics of each ensemble for an experiment and length:
+        along each figure's line by figure and order, or of a whole field by order.
+        """
+        recreate.check_length(exp, length)
+        if grid:
+            recreate.check_field(exp, field)
+        self.refresh()
+        with self.lock:
+            if not grid:
+                envelope = {}
+                for name, stats in self.figure_ensembles(exp).items():
+                    for (order, L), s in stats.items():
+                        if L == length:
+                            envelope.setdefault(name, {})[order] = {
+                                'count': s.count, 'min': s.amin, 'max': s.amax, 'mean': s.mean, 'std': s.std}
+                return envelope
+
+            key = (exp, field, length, tuple(percentiles or []))
+            if key not in self.envelopes:
+                self.envelopes[key] = recreate.field_ensemble(self.catalog, exp, field, [length],
+                                                              percentiles=percentiles)
+            return dict((order, stats) for (order, L), stats in self.envelopes[key].items())
+
+    def model_scores(self, exp, length, grid=False, field=None):
+        """Return the distances between the models and their leave-one-out scores (see ismip_compare.ensemble_scores)."""
+        recreate.check_length(exp, length)
+        if field is None:
+            field = 'surf_i' if exp == 'f' else 'vnorm_surf_i'
+        recreate.check_field(exp, field)
+        self.refresh()
+        with self.lock:
+            key = (exp, field, length, bool(grid))
+            if key not in self.scores:
+                self.scores[key] = ismip_compare.ensemble_scores(self.catalog, exp, field, length, grid)
+            return self.scores[key]
+
+    def status(self):
+        with self.lock:
+            return {'data_files': len(self.stamps),
+                    'loaded': sorted(df for df, d in self.catalog.datums.items()
+                                     if any(d.has(a) for a in recreate.ismip_datum.interp_attrs)),
+                    'figures': sorted(self.ensembles),
+                   }
+
+
+class request_handler(BaseHTTPRequestHandler):
+    """Answer the service's requests (see the module documentation)."""
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def reply(self, code, value):
+        body = json.dumps(jsonable(value)).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, method):
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        grid = query.get('grid', '0') not in ['', '0', 'false']
+        try:
+            if method == 'POST' and url.path == '/score':
+                content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                result = self.service.score(query['name'], content)
+            elif method == 'GET' and url.path == '/envelope':
+                percentiles = [float(q) for q in query['percentiles'].split(',')] if 'percentiles' in query else None
+                result = self.service.envelope(query['exp'], query['length'], grid,
+                                               query.get('field', 'vnorm_surf_i'), percentiles)
+            elif method == 'GET' and url.path == '/scores':
+                result = self.service.model_scores(query['exp'], query['length'], grid, query.get('field'))
+            elif method == 'GET' and url.path == '/status':
+                result = self.service.status()
+            else:
+                self.reply(404, {'error': 'no such request: '+method+' '+url.path})
+                return
+        except KeyError as e:
+            self.reply(400, {'error': 'missing parameter: '+str(e)})
+            return
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        self.reply(200, result)
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+
+class tcp_server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class unix_server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(service, host='127.0.0.1', port=8765, socket_file=None):
+    """Answer requests with the service, on host:port or a Unix socket, until interrupted or terminated."""
+    signal.signal(signal.SIGTERM, interrupt)
+    handler = type('handler', (request_handler,), {'service': service})
+    if socket_file is not None:
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        server = unix_server(socket_file, handler)
+        print("Serving on "+socket_file)
+    else:
+        server = tcp_server((host, port), handler)
+        print("Serving on http://{}:{}/".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_file is not None and os.path.exists(socket_file):
+            os.remove(socket_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve comparisons to the ISMIP-HOM ensembles.')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='The port to listen on.')
+    parser.add_argument('--socket', help='Listen on this Unix socket instead.')
+    parser.add_argument('--data-dir', default=recreate.ismip_data, help='Location of the ISMIP-HOM data.')
+    parser.add_argument('--cache-dir', default=recreate.cache_path, help='Location of the cache.')
+    parser.add_argument('--ppq', type=int, default=recreate.points_p_quarter,
+                        help='Interpolation grid points per quarter of each axis.')
+    parser.add_argument('--workers', type=int, default=recreate.workers,
+                        help='Worker processes to load the ensembles with at start up.')
+    parser.add_argument('--warm', nargs='*', default=['a','c','f'], choices=['a','c','f'],
+                        help='The experiments to load before serving.')
+    parser.add_argument('--reload-interval', type=float, default=reload_interval,
+                        help='How often to check the data for changes, in seconds.')
+    parser.add_argument('--keep-submissions', type=int, default=submission_cache_size,
+                        help='How many submitted data files to keep in the cache.')
+    args = parser.parse_args()
+
+    recreate.configure(ismip_data=args.data_dir, cache_path=args.cache_dir,
+                       points_p_quarter=args.ppq, workers=args.workers)
+    reload_interval = args.reload_interval
+    submission_cache_size = args.keep_submissions
+
+    service = comparison_service()
+    service.warm(args.warm)
+    # anything loaded later is loaded in the serving threads; a process pool
+    # shouldn't be forked from them
+    recreate.configure(workers=1)
+    serve(service, args.host, args.port, args.socket)
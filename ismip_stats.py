@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Streaming statistics of an ensemble of model results.
+
+Each model's line (or field) is added one at a time and only running
+min/max/mean/variance arrays are kept, using Welford's algorithm, so memory
+doesn't grow with the number of models. Partial statistics, e.g. from separate
+workers, can be merged.
+"""
+
+
+import numpy
+import warnings
+
+
+class ensemble_stats:
+    """
+    One-pass min/max/mean/std of an ensemble of equally shaped arrays.
+
+    If percentiles are requested, the arrays have to be kept to compute them, so
+    memory then grows with the size of the ensemble.
+    """
+    def __init__(self, percentiles=None):
+        self.count = 0
+        self.amin = None
+        self.amax = None
+        self.mean = None
+        self.m2 = None # sum of squared differences from the mean
+        self.percentiles = list(percentiles) if percentiles else []
+        self.members = []
+
+    def add(self, line):
+        """Add one model's line to the ensemble."""
+        line = numpy.array(line, dtype=numpy.float64)
+        self.count += 1
+        if self.count == 1:
+            self.amin = line.copy()
+            self.amax = line.copy()
+            self.mean = line.copy()
+            self.m2 = numpy.zeros_like(line)
+        else:
+            numpy.minimum(self.amin, line, out=self.amin)
+            numpy.maximum(self.amax, line, out=self.amax)
+            delta = line - self.mean
+            self.mean += delta/self.count
+            self.m2 += delta*(line - self.mean)
+        if self.percentiles:
+            self.members.append(line)
+
+    def merge(self, other):
+        """Merge the statistics of another ensemble into this one."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.amin = other.amin.copy()
+            self.amax = other.amax.copy()
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            numpy.minimum(self.amin, other.amin, out=self.amin)
+            numpy.maximum(self.amax, other.amax, out=self.amax)
+            self.mean += delta*(float(other.count)/count)
+            self.m2 += other.m2 + numpy.square(delta)*(float(self.count)*other.count/count)
+            self.count = count
+        if self.percentiles:
+            self.members.extend(other.members)
+
+    @property
+    def var(self):
+        """The (population) variance, like numpy.var."""
+        return self.m2/self.count
+
+    @property
+    def std(self):
+        """The (population) standard deviation, like numpy.std."""
+        return numpy.sqrt(self.var)
+
+    def percentile(self, q):
+        """Return the q-th percentile(s) of the ensemble."""
+        if not self.percentiles:
+            raise ValueError("Percentiles weren't requested for this ensemble.")
+        return numpy.percentile(numpy.array(self.members), q, axis=0)
+
+    def state(self):
+        """
+        Return the running statistics as a dict of arrays, e.g. to save with
+        numpy.savez. The members kept for percentiles aren't included.
+        """
+        return {'count': numpy.array(self.count), 'amin': self.amin, 'amax': self.amax,
+                'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_state(cls, state):
+        """Make an ensemble_stats from the running statistics returned by state."""
+        stats = cls()
+        stats.count = int(state['count'])
+        for name in ['amin', 'amax', 'mean', 'm2']:
+            stats.__dict__[name] = numpy.array(state[name], dtype=numpy.float64)
+        return stats
+
+    def results(self):
+        """Return a dict of the ensemble statistics."""
+        results = {'count': self.count, 'min': self.amin, 'max': self.amax, 
+                   'mean': self.mean, 'std': self.std}
+        for q in self.percentiles:
+            results['p{:g}'.format(q)] = self.percentile(q)
+        return results
+
+
+def group_stats(pairs, percentiles=None, groups=None):
+    """
+    Stream (key, line) pairs into an ensemble_stats per key, e.g. keyed by model
+    order and length. The lines are consumed one at a time, so pairs can be a
+    generator. Pass an existing dict of groups to add to it.
+
+    Returns the dict of ensemble_stats keyed by key.
+    """
+    if groups is None:
+        groups = {}
+    for key, line in pairs:
+        if key not in groups:
+            groups[key] = ensemble_stats(percentiles)
+        groups[key].add(line)
+    return groups
+
+
+def flatten_groups(groups):
+    """
+    Flatten a dict of dicts of arrays, keyed by tuples of strings, into a dict
+    of arrays named 'key/.../name', e.g. to save with numpy.savez.
+    """
+    flat = {}
+    for key, arrays in groups.items():
+        for name, array in arrays.items():
+            flat['/'.join(key+(name,))] = array
+    return flat
+
+
+def unflatten_groups(flat):
+    """Make the dict of dicts of arrays flattened by flatten_groups."""
+    groups = {}
+    for path, array in flat.items():
+        path = path.split('/')
+        groups.setdefault(tuple(path[:-1]), {})[path[-1]] = array
+    return groups
+
+
+def groups_state(groups):
+    """
+    Return the state of a dict of ensemble_stats keyed by tuples of strings (as
+    made by group_stats) as a flat dict of arrays named 'key/.../name'.
+    """
+    return flatten_groups(dict((key, stats.state()) for key, stats in groups.items()))
+
+
+def groups_from_state(state):
+    """Make the dict of ensemble_stats saved by groups_state."""
+    return dict((key, ensemble_stats.from_state(part)) for key, part in unflatten_groups(state).items())
+
+
+def cube_stats(fields, percentiles=None, chunk_bytes=64*2**20):
+    """
+    Statistics over an ensemble of equally shaped fields, e.g. each model's
+    interpolated (ny, nx) field: an (n_models, ny, nx) cube, or a list of the
+    fields (which may be memory-mapped).
+
+    The fields are stacked and reduced over the models a chunk of rows at a
+    time, so no more than about chunk_bytes of the cube is in memory at once.
+    Points that aren't finite in a field (e.g. outside the convex hull of its
+    data) are left out of the statistics at that point.
+
+    Returns a dict of fields: count (the number of finite values), min, max,
+    mean, std (the population standard deviation, like ensemble_stats) and
+    p<q> for each of the percentiles. Where no field has a finite value, the
+    statistics are NaN.
+    """
+    n = len(fields)
+    if not n:
+        raise ValueError("No fields to compute the statistics of.")
+    shape = numpy.shape(fields[0])
+    percentiles = list(percentiles) if percentiles else []
+
+    names = ['min', 'max', 'mean', 'std'] + ['p{:g}'.format(q) for q in percentiles]
+    results = dict((name, numpy.full(shape, numpy.nan)) for name in names)
+    results['count'] = numpy.zeros(shape, dtype=numpy.int64)
+
+    row_bytes = n * int(numpy.prod(shape[1:], dtype=numpy.int64)) * 8
+    rows = max(1, chunk_bytes // max(1, row_bytes))
+    with warnings.catch_warnings():
+        # all-NaN points are expected; they're left NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for start in range(0, shape[0], rows):
+            stop = min(start+rows, shape[0])
+            cube = numpy.stack([numpy.array(f[start:stop], dtype=numpy.float64) for f in fields])
+            finite = numpy.isfinite(cube)
+            cube[~finite] = numpy.nan
+
+            results['count'][start:stop] = finite.sum(axis=0)
+            results['min'][start:stop] = numpy.nanmin(cube, axis=0)
+            results['max'][start:stop] = numpy.nanmax(cube, axis=0)
+            results['mean'][start:stop] = numpy.nanmean(cube, axis=0)
+            results['std'][start:stop] = numpy.nanstd(cube, axis=0)
+            if percentiles:
+                values = numpy.nanpercentile(cube, percentiles, axis=0)
+                for q, value in zip(percentiles, values):
+                    results['p{:g}'.format(q)][start:stop] = value
+    return results
+
+
+def deviation(line, stats):
+    """
+    Measure how far a model's line is from an ensemble. Returns a dict of:
+        rmse      -- the root mean square difference from the ensemble mean
+        max_abs   -- the largest absolute difference from the ensemble mean
+        rel_rmse  -- the rmse relative to the root mean square of the mean
+        mean_z    -- the mean absolute difference in ensemble standard deviations
+                     (where the spread is zero, points are skipped)
+        inside    -- the fraction of points within the ensemble's min/max range
+    Points where the line or the ensemble isn't finite are ignored.
+    """
+    line = numpy.asarray(line, dtype=numpy.float64)
+    valid = numpy.isfinite(line) & numpy.isfinite(stats.mean) & numpy.isfinite(stats.m2)
+    diff = (line - stats.mean)[valid]
+    if not diff.size:
+        return {'rmse': numpy.nan, 'max_abs': numpy.nan, 'rel_rmse': numpy.nan,
+                'mean_z': numpy.nan, 'inside': numpy.nan}
+
+    rmse = numpy.sqrt(numpy.mean(numpy.square(diff)))
+    scale = numpy.sqrt(numpy.mean(numpy.square(stats.mean[valid])))
+    std = stats.std[valid]
+    spread = std > 0
+    inside = (line[valid] >= stats.amin[valid]) & (line[valid] <= stats.amax[valid])
+    return {'rmse': rmse,
+            'max_abs': numpy.max(numpy.abs(diff)),
+            'rel_rmse': rmse/scale if scale > 0 else numpy.nan,
+            'mean_z': numpy.mean(numpy.abs(diff[spread])/std[spread]) if spread.any() else numpy.nan,
+            'inside': numpy.mean(inside),
+           }
+
+
+def distances(lines, chunk_bytes=64*2**20):
+    """
+    All-pairs distances between models' lines (or flattened fields): an
+    (n_models, n_points) array. Returns a dict of (n_models, n_models) arrays:
+        rmse     -- the root mean square difference between two models
+        max_abs  -- the largest absolute difference between two models
+        count    -- the number of points where both models are finite
+    Only points where both models are finite are used; pairs without any are NaN.
+    The differences are computed for a block of models at a time, so no more
+    than about chunk_bytes of them are in memory at once.
+    """
+    lines = numpy.asarray(lines, dtype=numpy.float64)
+    n, points = lines.shape
+    results = {'rmse': numpy.full((n, n), numpy.nan),
+               'max_abs': numpy.full((n, n), numpy.nan),
+               'count': numpy.zeros((n, n), dtype=numpy.int64)}
+
+    rows = max(1, chunk_bytes // max(1, n*points*8))
+    for start in range(0, n, rows):
+        stop = min(start+rows, n)
+        diff = numpy.abs(lines[start:stop,None,:] - lines[None,:,:])
+        valid = numpy.isfinite(diff)
+        count = valid.sum(axis=2)
+        diff[~valid] = 0.0
+        some = count > 0
+        rmse = numpy.sqrt(numpy.square(diff).sum(axis=2)/numpy.maximum(count, 1))
+        results['count'][start:stop] = count
+        results['rmse'][start:stop] = numpy.where(some, rmse, numpy.nan)
+        results['max_abs'][start:stop] = numpy.where(some, diff.max(axis=2), numpy.nan)
+    return results
+
+
+def leave_one_out(lines, members):
+    """
+    Measure how far each model's line is from an ensemble of lines, leaving the
+    model itself out of the ensemble if it's a member: lines is an (n_models,
+    n_points) array and members is a boolean mask of the lines in the ensemble.
+
+    Returns a dict of the deviation metrics (see deviation), each an n_models
+    array. Like ensemble_stats, the ensemble isn't finite at points where any of
+    its (remaining) members isn't; those points are ignored.
+    """
+    lines = numpy.asarray(lines, dtype=numpy.float64)
+    members = numpy.asarray(members, dtype=bool)
+    finite = numpy.isfinite(lines)
+    inside = finite & members[:,None]
+    outside = ~finite & members[:,None]
+    own = inside.astype(numpy.float64)
+
+    # sums over the members, shifted by the full ensemble's mean so the
+    # leave-one-out variances don't lose precision
+    values = numpy.where(inside, lines, 0.0)
+    count = inside.sum(axis=0)
+    shift = values.sum(axis=0)/numpy.maximum(count, 1)
+    shifted = numpy.where(inside, lines - shift, 0.0)
+    s1 = shifted.sum(axis=0)
+    s2 = numpy.square(shifted).sum(axis=0)
+
+    # each line's ensemble, (n_models, n_points)
+    n = count - own
+    s1 = s1 - shifted
+    s2 = s2 - numpy.square(shifted)
+    missing = outside.sum(axis=0) - outside
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_shifted = s1/n
+        mean = mean_shifted + shift
+        var = numpy.maximum(s2/n - numpy.square(mean_shifted), 0.0)
+
+    # the ensemble range without each member: the next smallest/largest value
+    # if the line is the member's extreme
+    low = numpy.where(inside, lines, numpy.inf)
+    high = numpy.where(inside, lines, -numpy.inf)
+    if len(lines) > 1:
+        low = numpy.partition(low, 1, axis=0)[:2]
+        high = -numpy.partition(-high, 1, axis=0)[:2]
+    else:
+        low = numpy.concatenate([low, low+numpy.inf])
+        high = numpy.concatenate([high, high-numpy.inf])
+    amin = numpy.where(inside & (lines == low[0]), low[1], low[0])
+    amax = numpy.where(inside & (lines == high[0]), high[1], high[0])
+
+    # rounding shouldn't make a spread out of identical members
+    var[amin == amax] = 0.0
+    std = numpy.sqrt(var)
+
+    valid = finite & (n > 0) & (missing == 0)
+    points = valid.sum(axis=1)
+    some = points > 0
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        diff = numpy.where(valid, lines - mean, 0.0)
+        rmse = numpy.sqrt(numpy.square(diff).sum(axis=1)/points)
+        scale = numpy.sqrt(numpy.where(valid, numpy.square(mean), 0.0).sum(axis=1)/points)
+        spread = valid & (std > 0)
+        z = numpy.where(spread, numpy.abs(diff)/numpy.where(spread, std, 1.0), 0.0)
+        mean_z = z.sum(axis=1)/spread.sum(axis=1)
+        within = valid & (lines >= amin) & (lines <= amax)
+        return {'rmse': numpy.where(some, rmse, numpy.nan),
+                'max_abs': numpy.where(some, numpy.abs(diff).max(axis=1), numpy.nan),
+                'rel_rmse': numpy.where(some & (scale > 0), rmse/scale, numpy.nan),
+                'mean_z': numpy.where(spread.any(axis=1), mean_z, numpy.nan),
+                'inside': numpy.where(some, within.sum(axis=1)/points, numpy.nan),
+               }
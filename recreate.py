@@ -40,27 +40,90 @@ This script gathers all the ISMIP-HOM experiments' data.
 
 
 import os
+import sys
 import numpy
-import scipy
+import json
 import errno
 import fnmatch
-
-import scipy.interpolate
-import matplotlib.pyplot as plt
-
-# Location of ISMIP-HOM data
-#TODO: argparse this.
+import argparse
+import multiprocessing
+
+try:
+    from shutil import which as find_executable
+except ImportError: # Python 2
+    from distutils.spawn import find_executable
+
+import ismip_cache
+import ismip_parse
+import ismip_interp
+import ismip_stats
+import ismip_build
+import ismip_bundle
+import ismip_profile
+
+# Location of ISMIP-HOM data (--data-dir)
 ismip_data = './ismip_all'
 
-# Location to output files
-#TODO: argparse this.
+# Location to output files (--out-dir)
 out_path = './output/'
 
+# Location of the parsed data cache (--cache-dir)
+cache_path = './cache/'
+
+# Resolution of the interpolation grids: the number of grid points per quarter
+# of x_hat/y_hat (see ismip_datum.make_grid) (--ppq)
+points_p_quarter = 25
+
+# Maximum size (bytes) of the cached interpolation results
+interp_cache_size = 512*2**20
+
+# Type the interpolated fields are held as; numpy.float32 halves their size
+# (--float32)
+field_dtype = numpy.float64
+
+# Maximum size (bytes) of the interpolated fields held in memory; past it they're
+# spilled to memory-mapped files in the cache directory. None for no cap.
+# (--memory-cap, in MB)
+field_memory_cap = None
+
+# Number of worker processes used to load and interpolate the data, and to
+# render the figures when headless (--workers)
+workers = multiprocessing.cpu_count()
+
+# Render the figures without showing them, in parallel; by default when there
+# is no display to show them on (--show/--no-show)
+headless = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+# Typeset the figure text with LaTeX (True), matplotlib's mathtext (False), or
+# LaTeX only if it's installed (None) (--usetex/--no-usetex)
+usetex = None
+
+# Also write every ensemble statistic to this single, memory-mappable binary
+# file in the output directory (see ismip_bundle); None for only the text files
+# (--bundle)
+bundle_file = None
+
+# Record the wall time, CPU time and peak memory of each stage of the run, per
+# data file, and write them to this report in the output directory (a .json or
+# .csv file; see ismip_profile). None to not write a report. (--profile)
+profile_file = None
+
+# Print a summary table of the time and memory used by each stage of the run
+# (--profile-summary)
+profile_summary = False
+
+# Trace the peak memory of each stage when profiling; this slows the run down
+# (--no-profile-memory)
+profile_memory = True
+
+# Only list the outputs that would be rebuilt, without rebuilding them
+# (--dry-run)
+dry_run = False
+
 #--------------------------
 # ISMIP-HOM data constants 
 #--------------------------
-#NOTE: Not including 'aas1' as the files do not conform to the data standards.
-full_stokes = ['aas2','cma1','fpa2','ghg1','jvj1','mmr1','oga1','rhi1',
+full_stokes = ['aas1','aas2','cma1','fpa2','ghg1','jvj1','mmr1','oga1','rhi1',
                'rhi3','spr1','ssu1','yko1']
 
 lmla = ['ahu1','ahu2','bds1','cma2','fpa1','fsa1','mbr1','rhi2','tpa1']
@@ -71,15 +134,9 @@ higher_order = lmla + l1l2 + l1l1 + ltsml
 
 sia = ['oso1']
 
-# The ISMIP-HOM data file headers for each experiment.
-#NOTE: These aren't used and are just here for informational purposes. 
-header = {'a':['x_hat','y_hat','vx_surf','vy_surf','tau_xz','tau_yz','del_p'],
-          'b':['x_hat','vx_surf','vz_surf','tau_xz','del_p'],
-          'c':['x_hat','y_hat','vx_surf','vy_surf','vz_surf','vx_base', 'vy_base','tau_xz','tau_yz','del_p'],
-          'd':['x_hat','vx_surf','vz_surf','vx_base','tau_xz','del_p'],
-          'e':['x_hat','vx_surf','vz_surf','tau_xz','del_p'],
-          'f':['x_hat','y_hat','z_surf','vx','vy','vz'],
-         }
+# The ISMIP-HOM data file headers for each experiment; nonconforming data files
+# are adapted to these columns as they're loaded (see ismip_parse).
+header = ismip_parse.header
 
 
 def mkdir_p(path):
@@ -94,35 +151,87 @@ def mkdir_p(path):
         else: raise
 
 
-class ismip_datum:
-    """A class to hold and process each model's data"""
-    def __init__(self, data_file):
+# The interpolated fields held in memory (see field_memory_cap)
+fields_held = ismip_cache.field_store()
+
+
+class ismip_datum(object):
+    """
+    A class to hold and process each model's data.
+
+    The data file is parsed and classified when the datum is made, but by
+    default (lazy=True) the data isn't loaded, gridded or interpolated until
+    one of those attributes is first used. The results are then kept, except
+    the raw data array which is dropped once the data is interpolated (it's
+    reloaded from the cache if it's used again).
+
+    The grids are shared by every datum with the same grid size, and are
+    read-only.
+    """
+    # Attributes set by make_grid and interp_data
+    grid_attrs = ['points_p_quarter', 'x_hat', 'y_hat', 'x_hat_grid', 'y_hat_grid']
+    interp_attrs = ['vx_surf_i', 'vy_surf_i', 'vz_surf_i', 'vnorm_surf_i', 'surf_i']
+
+    # The interpolated fields of each experiment (see point_data and sample)
+    exp_fields = {'a': ['vx_surf_i', 'vy_surf_i', 'vnorm_surf_i'],
+                  'c': ['vx_surf_i', 'vy_surf_i', 'vz_surf_i', 'vnorm_surf_i'],
+                  'f': ['surf_i', 'vx_surf_i', 'vy_surf_i', 'vz_surf_i', 'vnorm_surf_i'],
+                 }
+
+    # interpolated is set once the data has been interpolated (see keep_fields)
+    __slots__ = ['df', 'M', 'E', 'L', 'order', 'array', 'interpolated'] + grid_attrs + interp_attrs
+
+    # The shared grids, by points_p_quarter
+    _grids = {}
+
+    # The hash of the code the fields are interpolated with (see interp_code)
+    _interp_code = None
+
+    def __init__(self, data_file, lazy=True):
         self.df = data_file
         self.M, self.E, self.L = self.parse_file(data_file)
         
         # classify
-        if self.M in full_stokes:
-            self.order = 'full_stokes'
-        elif self.M in higher_order:
-            self.order = 'higher_order'
-        elif self.M in sia:
-            self.order = 'sia'
-        else:
-            self.order = 'unknown'
+        self.order = self.classify(self.M)
         
-        # load the data
-        if self.order != 'unknown':
+        if not lazy:
+            # load the data
             self.array = self.load_data()
-        else:
-            self.array = numpy.array([])
-        
-        # get interpolation grid
-        self.make_grid(self.E)
+            
+            # get interpolation grid
+            self.make_grid(self.E)
 
-        # interpolate the data
-        self.interp_data(self.E)
+            # interpolate the data
+            self.interp_data(self.E)
 
-    def parse_file(self, data_file):
+    def __getattr__(self, name):
+        """Load, grid, or interpolate the data the first time it's needed."""
+        if name == 'array':
+            self.array = self.load_data()
+        elif name in ismip_datum.grid_attrs:
+            # get interpolation grid
+            self.make_grid(self.E)
+        elif name in ismip_datum.interp_attrs:
+            if name not in ismip_datum.exp_fields.get(self.E, []) or self.has('interpolated'):
+                raise AttributeError("Exp. "+self.E.upper()+" data has no "+name+" field")
+            # interpolate the data
+            self.interp_data(self.E)
+            if not self.has(name):
+                raise AttributeError("Exp. "+self.E.upper()+" data has no "+name+" field")
+        else:
+            raise AttributeError("'ismip_datum' object has no attribute '"+name+"'")
+        return object.__getattribute__(self, name)
+
+    def has(self, name):
+        """Whether an attribute is set, without loading, gridding or interpolating."""
+        try:
+            object.__getattribute__(self, name)
+        except AttributeError:
+            return False
+        return True
+
+    @staticmethod
+    def parse_file(data_file):
         """
         Parse the ismip_hom data filenames. They should look like: NNNMELLL.tex, where NNN = model name, 
              M = model number, E = experiment, LLL = three numbers denoting: 
@@ -130,12 +239,41 @@ class ismip_datum:
                  experiment e: 000 for non-sliding and 001 for the experiment with 
                                the zone of zero basal raction
                  experiment f: the slip ratio; either 000 or 001.
+
+        Files split into a surface and basal part (NNNMELLL_surf.txt and
+        NNNMELLL_base.txt) are named by the part.
         """
         code_name = str.lower(os.path.basename(os.path.splitext(data_file)[0]))
+        code_name = code_name.split('_')[0]
         return (code_name[0:4], code_name[4], code_name[5:]) # (model, experiment, length)
 
+    @staticmethod
+    def classify(model):
+        """Return the order of a model: full_stokes, higher_order, sia, or unknown."""
+        if model in full_stokes:
+            return 'full_stokes'
+        elif model in higher_order:
+            return 'higher_order'
+        elif model in sia:
+            return 'sia'
+        else:
+            return 'unknown'
+
+    def labels(self):
+        """The labels of this datum's stages in a profile (see ismip_profile)."""
+        return {'file': self.df, 'model': self.M, 'exp': self.E, 'length': self.L}
+
     def load_data(self):
-        data = numpy.loadtxt(self.df)
+        """
+        Load the data file. The parsed array is kept in a binary cache (see
+        ismip_cache) so the text is only re-parsed when the file changes, and is
+        memory-mapped from it. Data from models of unknown order isn't used, so
+        it isn't loaded.
+        """
+        if self.order == 'unknown':
+            return numpy.array([])
+        with ismip_profile.stage('load', **self.labels()):
+            data = ismip_cache.load(self.df, cache_dir=cache_path, mmap_mode='r')
         return data
 
     def make_grid(self, exp):
@@ -151,52 +289,142 @@ class ismip_datum:
             #NOTE: linspace(start, stop, num) returns num points across the
             #      start->stop interval, including start and stop. So, to always hit
             #      1/4 and 1/2, you need X+1 points, where X%4 == 0. 
-            self.points_p_quarter = 25
-            self.x_hat = numpy.linspace(0.0, 1.0, self.points_p_quarter*4+1)
-            self.y_hat = numpy.linspace(0.0, 1.0, self.points_p_quarter*4+1)
-            self.x_hat_grid, self.y_hat_grid = scipy.meshgrid(self.x_hat, self.y_hat)
+            self.points_p_quarter = points_p_quarter
         else:
-            self.x_hat = numpy.array([])
-            self.y_hat = numpy.array([])
-            self.x_hat_grid = numpy.array([])
-            self.y_hat_grid = numpy.array([])
+            self.points_p_quarter = None
 
-    def interp_data(self, exp):
-        if self.x_hat_grid.size and exp in ['a','c']:
-            self.vx_surf_i = scipy.interpolate.griddata(self.array[:,0:2], self.array[:,2], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-            self.vy_surf_i = scipy.interpolate.griddata(self.array[:,0:2], self.array[:,3], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-            if exp in ['c']:
-                self.vz_surf_i = scipy.interpolate.griddata(self.array[:,0:2], self.array[:,4], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-                self.vnorm_surf_i = numpy.sqrt( numpy.square(self.vx_surf_i) + numpy.square(self.vy_surf_i) + numpy.square(self.vz_surf_i) )
+        if self.points_p_quarter not in ismip_datum._grids:
+            if self.points_p_quarter is None:
+                axis = numpy.array([])
+                grids = [axis, axis, axis, axis]
             else:
-                self.vnorm_surf_i = numpy.sqrt( numpy.square(self.vx_surf_i) + numpy.square(self.vy_surf_i) )
-            
-            self.vx_surf_i = self.vx_surf_i.reshape(self.x_hat_grid.shape)
-            self.vy_surf_i = self.vy_surf_i.reshape(self.x_hat_grid.shape)
-            if exp in ['c']:
-                self.vz_surf_i = self.vz_surf_i.reshape(self.x_hat_grid.shape)
-            self.vnorm_surf_i = self.vnorm_surf_i.reshape(self.x_hat_grid.shape)
-
-        elif self.x_hat_grid.size and exp in ['f']:
+                axis = numpy.linspace(0.0, 1.0, self.points_p_quarter*4+1)
+                grids = [axis, axis] + list(numpy.meshgrid(axis, axis))
+            for grid in grids:
+                grid.flags.writeable = False
+            ismip_datum._grids[self.points_p_quarter] = grids
+        self.x_hat, self.y_hat, self.x_hat_grid, self.y_hat_grid = ismip_datum._grids[self.points_p_quarter]
+
+    def point_data(self):
+        """
+        Return the (x_hat, y_hat) points of the data, the columns of values that
+        are interpolated from them, and the names of those columns.
+        """
+        if self.E in ['a']:
+            return self.array[:,0:2], self.array[:,2:4], ['vx_surf','vy_surf']
+        elif self.E in ['c']:
+            return self.array[:,0:2], self.array[:,2:5], ['vx_surf','vy_surf','vz_surf']
+        elif self.E in ['f']:
             #NOTE: Some of the Exp. F data is reported in the scaled coordinate system 
             #      (x_hat), and others is reported in the cartesian coordinate system (x).
             #      This normalizes the coordinate systems. 
-            xy_f = self.array[:,0:2]
-            if xy_f[0,0] < -1.0:
-                xy_f = xy_f/100.0 + 0.5
-            
-            self.surf_i = scipy.interpolate.griddata(   xy_f, self.array[:,2], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-            self.vx_surf_i = scipy.interpolate.griddata(xy_f, self.array[:,3], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-            self.vy_surf_i = scipy.interpolate.griddata(xy_f, self.array[:,4], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-            self.vz_surf_i = scipy.interpolate.griddata(xy_f, self.array[:,5], (self.x_hat_grid.ravel(), self.y_hat_grid.ravel()), method='linear')
-            
-            self.vnorm_surf_i = numpy.sqrt( numpy.square(self.vx_surf_i) + numpy.square(self.vy_surf_i) + numpy.square(self.vz_surf_i) )
-            
-            self.surf_i = self.surf_i.reshape(self.x_hat_grid.shape)
-            self.vx_surf_i = self.vx_surf_i.reshape(self.x_hat_grid.shape)
-            self.vy_surf_i = self.vy_surf_i.reshape(self.x_hat_grid.shape)
-            self.vz_surf_i = self.vz_surf_i.reshape(self.x_hat_grid.shape)
-            self.vnorm_surf_i = self.vnorm_surf_i.reshape(self.x_hat_grid.shape)
+            xy_f = ismip_interp.normalize_xy(self.array[:,0:2])
+            return xy_f, self.array[:,2:6], ['surf','vx_surf','vy_surf','vz_surf']
+        raise ValueError("Exp. "+self.E.upper()+" data isn't reported on an x_hat/y_hat plane")
+
+    def sample(self, x_hat, y_hat):
+        """
+        Linearly interpolate the data at arbitrary (x_hat, y_hat) points. 
+
+        x_hat and y_hat can be arrays of any (broadcastable) shape, and all the
+        points are located in the data in a single batch, over a (shared)
+        triangulation of the data points, or with a rectilinear interpolator
+        for data on a lattice if ismip_interp.structured is set.
+
+        Returns a dict of the sampled fields (vx_surf, vy_surf, vnorm_surf and,
+        depending on the experiment, vz_surf and surf), each the shape of the
+        points.
+        """
+        points, values, names = self.point_data()
+        x_hat, y_hat = numpy.broadcast_arrays(numpy.asarray(x_hat, dtype=float), numpy.asarray(y_hat, dtype=float))
+        samples = ismip_interp.interpolate(points, values, (x_hat, y_hat))
+
+        fields = dict((name, samples[...,i]) for i, name in enumerate(names))
+        if 'vz_surf' in fields:
+            fields['vnorm_surf'] = numpy.sqrt( numpy.square(fields['vx_surf']) + numpy.square(fields['vy_surf']) + numpy.square(fields['vz_surf']) )
+        else:
+            fields['vnorm_surf'] = numpy.sqrt( numpy.square(fields['vx_surf']) + numpy.square(fields['vy_surf']) )
+        return fields
+
+    def transect(self, y_hat=None, x_hat=None, points=101):
+        """
+        Sample the data along lines of constant y_hat (x_hat from 0 to 1), or of
+        constant x_hat (y_hat from 0 to 1), with the given number of points.
+
+        For example, transect(y_hat=0.25) samples the line y = L/4 and
+        transect(x_hat=0.5) the line x = L/2. Give a list of values to sample
+        many transects at once.
+
+        Returns the coordinate along the transects and a dict of the sampled
+        fields (see sample); each field has a row per transect if a list was
+        given.
+        """
+        if (y_hat is None) == (x_hat is None):
+            raise ValueError("Give exactly one of y_hat or x_hat.")
+        along = numpy.linspace(0.0, 1.0, points)
+        if y_hat is not None:
+            across = numpy.asarray(y_hat, dtype=float)[...,numpy.newaxis]
+            return along, self.sample(along, across)
+        across = numpy.asarray(x_hat, dtype=float)[...,numpy.newaxis]
+        return along, self.sample(across, along)
+
+    def interp_data(self, exp):
+        """
+        Interpolate the data onto the grid, and keep the interpolated fields.
+        """
+        self.keep_fields(self.interp_fields(exp))
+
+    def interp_fields(self, exp):
+        """
+        Return a dict of the data interpolated onto the grid, or an empty dict
+        for experiments that aren't interpolated. The interpolated fields are
+        kept in the interpolation cache (see ismip_cache), keyed by the data
+        file's contents and the interpolation settings, so an unchanged file is
+        only ever interpolated once.
+        """
+        if not self.x_hat_grid.size or exp not in ['a','c','f']:
+            return {}
+
+        spec = self.interp_spec()
+        with ismip_profile.stage('load_fields', **self.labels()):
+            fields = ismip_cache.load_fields(self.df, spec, cache_dir=cache_path)
+        if fields is None:
+            with ismip_profile.stage('interpolate', **self.labels()):
+                fields = dict((name+'_i', field) for name, field in self.sample(self.x_hat_grid, self.y_hat_grid).items())
+                ismip_cache.store_fields(self.df, spec, fields, cache_dir=cache_path)
+        return fields
+
+    def interp_spec(self):
+        """The interpolation settings, which key the interpolation cache."""
+        return {'points_p_quarter': self.points_p_quarter,
+                'method': ismip_interp.method(),
+                'code': ismip_datum.interp_code(),
+               }
+
+    @staticmethod
+    def interp_code():
+        """
+        A hash of the code the interpolated fields are computed with: the parser,
+        the interpolators and the datum methods that pick the points and columns
+        (see ismip_build.source_hash). It's taken once, from the code running.
+        """
+        if ismip_datum._interp_code is None:
+            ismip_datum._interp_code = ismip_build.source_hash(
+                ['ismip_parse', 'ismip_interp', ismip_datum.make_grid, ismip_datum.point_data,
+                 ismip_datum.sample, ismip_datum.interp_fields])
+        return ismip_datum._interp_code
+
+    def keep_fields(self, fields):
+        """
+        Keep a dict of interpolated fields as field_dtype, within the memory cap
+        (see field_memory_cap), and drop the raw data array.
+        """
+        for name, field in fields.items():
+            field = numpy.ascontiguousarray(field, dtype=field_dtype)
+            setattr(self, name, fields_held.hold(field, field_memory_cap, os.path.join(cache_path, 'spill')))
+        self.interpolated = True
+        if fields and self.has('array'):
+            del self.array
 
     def display(self):
         print("Data file: "+self.df)
@@ -216,19 +444,462 @@ def recursive_glob(tree, pattern):
         matches.extend(os.path.join(base, f) for f in goodfiles)
     return matches
 
-data_files = recursive_glob(ismip_data, '*.txt')
 
-all_data = []
-for i, df in enumerate(data_files):
-    all_data.append(ismip_datum(df))
-    #all_data[i].display()
-    #print("------")
+class ismip_catalog:
+    """
+    An index of the ISMIP-HOM data files by (order, model, experiment, length).
+
+    The index is built only from the data file names, so nothing is loaded
+    until the datums returned by query are used. It is saved to index_file and
+    reused as long as none of the data directories have changed.
+    """
+    def __init__(self, tree, index_file=None):
+        self.tree = tree
+        self.index_file = index_file
+        self.datums = {}
+
+        files = self.load_index()
+        if files is None:
+            with ismip_profile.stage('glob', tree=tree):
+                files = sorted(recursive_glob(tree, '*.txt'))
+            self.save_index(files)
+        files = ismip_parse.data_files(files)
+
+        self.index = {}
+        for df in files:
+            model, exp, length = ismip_datum.parse_file(df)
+            key = (ismip_datum.classify(model), model, exp, length)
+            self.index.setdefault(key, []).append(df)
+
+    def dir_mtimes(self, dirs=None):
+        """
+        Return the modification time of each directory in dirs (default: every
+        directory in the tree). Adding or removing a file or a subdirectory
+        changes the mtime of the directory it's in.
+        """
+        if dirs is None:
+            dirs = [base for base, subdirs, files in os.walk(self.tree)]
+        mtimes = {}
+        for d in dirs:
+            try:
+                mtimes[d] = os.stat(d).st_mtime
+            except OSError:
+                mtimes[d] = None
+        return mtimes
+
+    def load_index(self):
+        """Return the saved list of data files, or None if it's missing or out of date."""
+        if self.index_file is None or not os.path.isfile(self.index_file):
+            return None
+        try:
+            with open(self.index_file) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if saved.get('tree') != os.path.abspath(self.tree) or saved['dirs'] != self.dir_mtimes(saved['dirs']):
+            return None
+        return saved['files']
+
+    def save_index(self, files):
+        if self.index_file is None:
+            return
+        try:
+            mkdir_p(os.path.dirname(self.index_file))
+            with open(self.index_file, 'w') as f:
+                json.dump({'tree': os.path.abspath(self.tree), 'dirs': self.dir_mtimes(), 'files': files}, f)
+        except (IOError, OSError):
+            pass # the index is rebuilt next time
+
+    def files(self, order=None, model=None, exp=None, length=None):
+        """
+        Return the sorted data files matching the query. Each argument may be a
+        single value or a list of values; None matches everything.
+        """
+        def match(value, want):
+            if want is None:
+                return True
+            if isinstance(want, str):
+                return value == want
+            return value in want
+
+        matches = []
+        for (o, m, e, l), dfs in self.index.items():
+            if match(o, order) and match(m, model) and match(e, exp) and match(l, length):
+                matches.extend(dfs)
+        return sorted(matches)
+
+    def query(self, order=None, model=None, exp=None, length=None):
+        """
+        Return the (lazy) ismip_datum for each data file matching the query. The
+        same datum is returned every time a file matches, so any data it has
+        loaded or interpolated is shared between queries.
+        """
+        matches = []
+        for df in self.files(order, model, exp, length):
+            if df not in self.datums:
+                self.datums[df] = ismip_datum(df)
+            matches.append(self.datums[df])
+        return matches
+
+
+# The settings worker processes need to work like the main process
+worker_settings = ['cache_path', 'points_p_quarter', 'usetex']
+
+# The ismip_interp settings they need, as they decide how the data is interpolated
+interp_settings = ['structured']
+
+
+def init_worker(settings, interp, profile_args):
+    """
+    Set up a (pool) worker process with the main process' settings (and
+    ismip_interp's), which it doesn't inherit if it isn't forked, and profiling
+    (see ismip_profile).
+    """
+    globals().update(settings)
+    for name, value in interp.items():
+        setattr(ismip_interp, name, value)
+    ismip_profile.init_worker(*profile_args)
+
+
+def worker_args():
+    """The arguments for init_worker to set up workers like this process."""
+    return (dict((name, globals()[name]) for name in worker_settings),
+            dict((name, getattr(ismip_interp, name)) for name in interp_settings),
+            ismip_profile.worker_args())
+
+
+def interp_worker(data_file):
+    """
+    Load and interpolate a single data file. Only the interpolated fields are
+    returned, so the raw data array isn't sent back from the worker, along with
+    the worker's profile records.
+    """
+    datum = ismip_datum(data_file)
+    return datum.interp_fields(datum.E), ismip_profile.take()
+
+
+def interp_all(datums, workers=1):
+    """
+    Load and interpolate the datums' data across a pool of worker processes.
+
+    Each file is processed independently in a worker and the interpolated fields
+    are stored on the (lazy) datums in the order given. Datums that have already
+    been interpolated, or that have no interpolated fields, are skipped.
+    """
+    todo = [d for d in datums if d.E in ['a','c','f'] and d.order != 'unknown' and not d.has('interpolated')]
+    if workers <= 1 or len(todo) < 2:
+        for d in todo:
+            d.interp_data(d.E)
+        return
+
+    pool = multiprocessing.Pool(min(workers, len(todo)), init_worker, worker_args())
+    try:
+        chunksize = max(1, len(todo)//(4*workers))
+        results = pool.map(interp_worker, [d.df for d in todo], chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+    for d, (fields, records) in zip(todo, results):
+        d.keep_fields(fields)
+        ismip_profile.records.extend(records)
+
+
+def ensemble(catalog, exp, line, lengths=None, orders=None):
+    """
+    Stream each full-Stokes and higher-order model's line for an experiment,
+    given by line(datum), into ensemble statistics grouped by (order, length).
+    The lengths and orders can be limited to lists of them.
+    """
+    datums = catalog.query(order=orders or ['full_stokes','higher_order'], exp=exp, length=lengths)
+    return ismip_stats.group_stats(((data.order, data.L), line(data)) for data in datums)
+
+
+def figure_line(data, field):
+    """
+    Return the line of an interpolated field (e.g. 'vnorm_surf_i') that the
+    figures are drawn along: the points_p_quarter column for Exp. A and C, i.e.
+    x = 1/4 x_hat along y_hat (transect(x_hat=0.25)), and the 2*points_p_quarter
+    row for Exp. F, i.e. y = 1/2 y_hat along x_hat (transect(y_hat=0.5)).
+    """
+    if data.E == 'f':
+        return getattr(data, field)[data.points_p_quarter*2,:]
+    return getattr(data, field)[:,data.points_p_quarter]
+
+
+# The ensemble statistics written out with each figure (see build_figure):
+#   (output name, experiment, lengths, axis name, field)
+figure_stats = [('ExpA_Fig5',  'a', ['005','010','020','040','080','160'], 'x_hat', 'vnorm_surf_i'),
+                ('ExpC_Fig8',  'c', ['005','010','020','040','080','160'], 'x_hat', 'vnorm_surf_i'),
+                ('ExpF_Fig12', 'f', ['000','001'], 'y_hat', 'surf_i'),
+                ('ExpF_Fig13', 'f', ['000','001'], 'y_hat', 'vnorm_surf_i'),
+               ]
+
+
+def ensemble_inputs(datums, exp, field):
+    """
+    What ensemble statistics of the datums' field depend on, including the code
+    that computes them (see code_version); these key the ensemble cache.
+    """
+    return {'exp': exp,
+            'field': field,
+            'code': code_version(),
+            'dtype': numpy.dtype(field_dtype).name,
+            'interp': datums[0].interp_spec() if datums else None,
+            'members': [[d.order, d.L, ismip_cache.content_hash(d.df, cache_path)] for d in datums],
+           }
+
+
+def cached_ensemble(catalog, exp, field, lengths=None, orders=None):
+    """
+    Return the ensemble statistics of a field along the figure line (see
+    figure_line), grouped by (order, length), optionally only for lists of
+    lengths and orders. They're kept in the ensemble cache keyed by the member
+    files' contents and the interpolation settings, so they're only recomputed
+    when the ensemble changes.
+    """
+    datums = catalog.query(order=orders or ['full_stokes','higher_order'], exp=exp, length=lengths)
+    inputs = ensemble_inputs(datums, exp, field)
+    state = ismip_cache.load_ensemble(inputs, cache_dir=cache_path)
+    if state is not None:
+        return ismip_stats.groups_from_state(state)
+
+    with ismip_profile.stage('interp_all', exp=exp):
+        interp_all(datums, workers)
+    with ismip_profile.stage('ensemble', exp=exp, field=field):
+        stats = ensemble(catalog, exp, lambda data: figure_line(data, field), lengths, orders)
+        ismip_cache.store_ensemble(inputs, ismip_stats.groups_state(stats), cache_dir=cache_path)
+    return stats
+
+
+def check_field(exp, field):
+    """Raise a ValueError unless field is one of the interpolated fields of exp."""
+    fields = ismip_datum.exp_fields.get(exp)
+    if fields is None:
+        raise ValueError("Exp. "+str(exp).upper()+" isn't interpolated; choose from "+
+                         ", ".join(e.upper() for e in sorted(ismip_datum.exp_fields)))
+    if field not in fields:
+        raise ValueError("Exp. "+exp.upper()+" has no "+str(field)+" field; choose from "+", ".join(fields))
+
+
+def check_length(exp, length):
+    """Raise a ValueError unless length is one of the lengths of exp's figures (see figure_stats)."""
+    lengths = sorted(set(l for name, figure_exp, figure_lengths, axis_name, field in figure_stats
+                         if figure_exp == exp for l in figure_lengths))
+    if not lengths:
+        raise ValueError("Exp. "+str(exp).upper()+" has no figures; choose from "+
+                         ", ".join(sorted(set(figure_exp.upper() for name, figure_exp, figure_lengths,
+                                              axis_name, field in figure_stats))))
+    if length not in lengths:
+        raise ValueError("Exp. "+exp.upper()+" has no length "+str(length)+"; choose from "+", ".join(lengths))
+
+
+def field_ensemble(catalog, exp, field='vnorm_surf_i', lengths=None, orders=None, percentiles=None):
+    """
+    Return the statistics of a whole interpolated field (e.g. vnorm_surf_i, or
+    surf_i for Exp. F) over each ensemble, for spatial envelope maps: a dict of
+    (ny, nx) count/min/max/mean/std/percentile fields (see
+    ismip_stats.cube_stats) keyed by (order, length). Lists of lengths and
+    orders can be selected. The results are cached like cached_ensemble.
+    """
+    check_field(exp, field)
+    datums = catalog.query(order=orders or ['full_stokes','higher_order'], exp=exp, length=lengths)
+    inputs = dict(ensemble_inputs(datums, exp, field), stats='field',
+                  percentiles=list(percentiles) if percentiles else [])
+    state = ismip_cache.load_ensemble(inputs, cache_dir=cache_path)
+    if state is not None:
+        return ismip_stats.unflatten_groups(state)
+
+    with ismip_profile.stage('interp_all', exp=exp):
+        interp_all(datums, workers)
+    groups = {}
+    for d in datums:
+        groups.setdefault((d.order, d.L), []).append(d)
+    results = {}
+    with ismip_profile.stage('field_ensemble', exp=exp, field=field):
+        for key, members in groups.items():
+            results[key] = ismip_stats.cube_stats([getattr(d, field) for d in members], percentiles)
+    ismip_cache.store_ensemble(inputs, ismip_stats.flatten_groups(results), cache_dir=cache_path)
+    return results
+
+
+def write_stats(out_file, axis_name, axis, fs_stats, ho_stats):
+    """
+    Write the full-Stokes and higher-order ensemble statistics along axis to a
+    text file. Either may be None (e.g. if that order wasn't selected), and is
+    written as NaN.
+    """
+    if fs_stats is None or ho_stats is None:
+        missing = ismip_stats.ensemble_stats()
+        missing.add(numpy.full(len(axis), numpy.nan))
+        fs_stats = fs_stats or missing
+        ho_stats = ho_stats or missing
+    out_data = numpy.column_stack((axis, fs_stats.amin, fs_stats.amax, fs_stats.mean, fs_stats.std, 
+                                         ho_stats.amin, ho_stats.amax, ho_stats.mean, ho_stats.std ))
+    out_header = [axis_name,  'full-stokes min',  'full-stokes max',  'full-stokes mean',  'full-stokes std', 
+                             'higher-order min', 'higher-order max', 'higher-order mean', 'higher-order std' ]
+    numpy.savetxt(out_file, out_data, delimiter=',', header=','.join(out_header))
+
+
+#---------
+# Figures
+#---------
+def use_latex():
+    """Check whether LaTeX is available to typeset the figure text."""
+    return all(find_executable(exe) for exe in ['latex', 'dvipng'])
+
+
+def pyplot():
+    """
+    Return matplotlib.pyplot, which is slow to import, so it's only imported
+    once a figure is made.
+    """
+    import matplotlib.pyplot
+    return matplotlib.pyplot
+
+
+def setup_figure(num):
+    plt = pyplot()
+    if usetex is None:
+        plt.rc('text', usetex=use_latex())
+    else:
+        plt.rc('text', usetex=usetex)
+    plt.rc('font', family='serif')
+    return plt.figure(num, figsize=(10,8), dpi=150)
+
+
+def finish_figure(fig, out_file):
+    plt = pyplot()
+    plt.savefig(out_file+'.png', bbox_inches='tight')
+    if headless:
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def plot_lengths(num, stats, x_hat, out_file):
+    """
+    Plot the full-Stokes and higher-order ensemble ranges and means of the
+    surface velocity for each length scale L, as in figures 5 and 8. Lengths
+    and orders missing from the stats are left out.
+    """
+    fig = setup_figure(num)
+    plt = pyplot()
+
+    plot_ls = ['005','010','020','040','080','160']
+    for i, l in enumerate(plot_ls):
+        fs = stats.get(('full_stokes', l))
+        ho = stats.get(('higher_order', l))
+        if fs is None and ho is None:
+            continue
+
+        plt.subplot(2,3,i+1)
+
+        if ho is not None:
+            plt.fill_between(x_hat.T, ho.amin, ho.amax, facecolor='green', alpha=0.5)
+        if fs is not None:
+            plt.fill_between(x_hat.T, fs.amin, fs.amax, facecolor='blue', alpha=0.5)
+
+        if fs is not None:
+            plt.plot(x_hat.T, fs.mean, 'b-', linewidth=2)
+        if ho is not None:
+            plt.plot(x_hat.T, ho.mean, 'g-', linewidth=2)
+
+        if i+1 > 3:
+            plt.xlabel('Normalized x')
+        if i+1 == 1 or i+1 == 4:
+            plt.ylabel('Velocity (m a$^{-1}$)')
+
+        plt.title(str(int(l))+'km')
+
+    finish_figure(fig, out_file)
+
+
+def plot_slip(num, stats, y_hat, ylabel, out_file):
+    """
+    Plot the full-Stokes and higher-order ensemble ranges and means along the
+    central flowline for the no-slip and slip beds, as in figures 12 and 13.
+    Lengths and orders missing from the stats are left out.
+    """
+    fig = setup_figure(num)
+    plt = pyplot()
+
+    plot_ls = ['000','001']
+    for i, l in enumerate(plot_ls):
+        fs = stats.get(('full_stokes', l))
+        ho = stats.get(('higher_order', l))
+        if fs is None and ho is None:
+            continue
+
+        plt.subplot(2,1,i+1)
+
+        if ho is not None:
+            plt.fill_between(y_hat.T, ho.amin, ho.amax, facecolor='green', alpha=0.5)
+        if fs is not None:
+            plt.fill_between(y_hat.T, fs.amin, fs.amax, facecolor='blue', alpha=0.5)
+
+        if fs is not None:
+            plt.plot(y_hat.T, fs.mean, 'b-', linewidth=2)
+        if ho is not None:
+            plt.plot(y_hat.T, ho.mean, 'g-', linewidth=2)
+
+        if i+1 > 1:
+            plt.xlabel('Distance from center (km)')
+        if l == '000':
+            plt.title('No-Slip Bed')
+        else:
+            plt.title('Slip Bed')
+
+        plt.ylabel(ylabel)
+
+    finish_figure(fig, out_file)
+
+
+def render(figure):
+    """Render one (plot function, arguments) figure."""
+    plot, args = figure
+    with ismip_profile.stage('render', figure=os.path.basename(args[-1])):
+        plot(*args)
+
+
+def render_worker(figure):
+    """Render one figure in a worker process, and return its profile records."""
+    render(figure)
+    return ismip_profile.take()
 
 
-#-----------------------
-# Setup the ouput files 
-#-----------------------
-mkdir_p(out_path)
+def render_headless(settings, interp, profile_args):
+    """Set up a worker process to render figures; see init_worker."""
+    init_worker(settings, interp, profile_args)
+    pyplot().switch_backend('agg')
+
+
+def render_all(figures, workers=1):
+    """
+    Render the (plot function, arguments) figures. In headless mode, the figures
+    are rendered concurrently across worker processes with a non-interactive
+    backend; otherwise they're shown one after another.
+    """
+    if not headless or workers <= 1 or len(figures) < 2:
+        if headless:
+            pyplot().switch_backend('agg')
+        for figure in figures:
+            render(figure)
+        return
+
+    pool = multiprocessing.Pool(min(workers, len(figures)), render_headless, worker_args())
+    try:
+        results = pool.map(render_worker, figures, 1)
+    finally:
+        pool.close()
+        pool.join()
+    for records in results:
+        ismip_profile.records.extend(records)
+
+
+def code_version():
+    """A hash of the code the outputs are made with (see ismip_build.source_hash)."""
+    return ismip_build.source_hash([__name__, 'ismip_parse', 'ismip_interp', 'ismip_stats'])
 
 
 #------------------------------------------------------------------------
@@ -241,243 +912,308 @@ mkdir_p(out_path)
 #NOTE: Exp. A and C plot at y = L/4 or 1/4 y_hat, x = [0,..,1]x_hat
 #NOTE: Exp. F plots at the central flowline in the ice-flow direction
 #         y = [0,..,1]y_hat, x = 1/2 x_hat
+#
+# How each figure in figure_stats is plotted: (plot function, arguments)
+figure_plots = {
+    # figure 5: Results for Exp. A: norm of the surface velocity across the bump at
+    # y=L/4 for different length scales L. The mean value and standard deviation are
+    # shown for both types of models. 
+    #   There are 6 plot boxes for 5,10,20,40,80,160 km, and all have: 
+    #       x_title     = Normalized x
+    #       y_title     = Velocity (m a^{-1})
+    #       Blue line   = FS Mean
+    #       Blue shade  = FS range
+    #       Green line  = NFS mean
+    #       Green shade = NFS range
+    'ExpA_Fig5': (plot_lengths, (5,)),
+
+    # figure 8: Results for Exp. C: norm of the surface velocity at y=L/4 for
+    # different length scales L. The mean value and standard deviation are shown for
+    # both types of models. 
+    #   There are 6 plot boxes for 5,10,20,40,80,160 km, and all have: 
+    #       x_title     = Normalized x
+    #       y_title     = Velocity (m a^{-1})
+    #       Blue line   = FS Mean
+    #       Blue shade  = FS range
+    #       Green line  = NFS mean
+    #       Green shade = NFS range
+    'ExpC_Fig8': (plot_lengths, (8,)),
+
+    # figure 12: Stead state surface elevation along the central flowline for Exp. F
+    # for the no-sliding (top) and sliding (bottom) experiment. The black line
+    # indicates the analytical solution [Note: I don't actually see this in the
+    # figure].
+    #   The 2 plot boxes have: 
+    #       x_title     = Distance from center (km)
+    #       y_title     = Surface (m)
+    #       Blue line   = FS Mean
+    #       Blue shade  = FS range
+    #       Green line  = NFS mean
+    #       Green shade = NFS range
+    'ExpF_Fig12': (plot_slip, (12, 'Surface (m)')),
+
+    # figure 13: Norm of the stead state surface velocity along the central flowline for Exp. F
+    # for the no-sliding (top) and sliding (bottom) experiment. The black line
+    # indicates the analytical solution [Note: I don't actually see this in the
+    # figure].
+    #   The 2 plot boxes have: 
+    #       x_title     = Distance from center (km)
+    #       y_title     = Surface (m)
+    #       Blue line   = FS Mean
+    #       Blue shade  = FS range
+    #       Green line  = NFS mean
+    #       Green shade = NFS range
+    'ExpF_Fig13': (plot_slip, (13, 'Velocity (m a$^{-1}$)')),
+}
+
+
+def select_figures(exps=None, lengths=None):
+    """
+    Return the (output name, experiment, lengths, axis name, field) of each
+    figure in figure_stats for the given experiments, limited to the given
+    lengths; None selects all of them. Figures left with no lengths are dropped.
+    """
+    selected = []
+    for name, exp, figure_lengths, axis_name, field in figure_stats:
+        figure_lengths = [l for l in figure_lengths if lengths is None or l in lengths]
+        if (exps is None or exp in exps) and figure_lengths:
+            selected.append((name, exp, figure_lengths, axis_name, field))
+    return selected
 
-fs_data = [data for data in all_data if data.order == 'full_stokes']
-ho_data = [data for data in all_data if data.order in 'higher_order']
-
-# figure 5: Results for Exp. A: norm of the surface velocity across the bump at
-# y=L/4 for different length scales L. The mean value and standard deviation are
-# shown for both types of models. 
-#   There are 6 plot boxes for 5,10,20,40,80,160 km, and all have: 
-#       x_title     = Normalized x
-#       y_title     = Velocity (m a^{-1})
-#       Blue line   = FS Mean
-#       Blue shade  = FS range
-#       Green line  = NFS mean
-#       Green shade = NFS range
-fs_data_a = [data for data in fs_data if data.E == 'a']
-ho_data_a = [data for data in ho_data if data.E == 'a']
-
-plt.figure(5, figsize=(10,8), dpi=150)
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif')
-
-plot_ls = ['005','010','020','040','080','160']
-for i, l in enumerate(plot_ls):
-    a_fs_lines = numpy.array([data.vnorm_surf_i[:,data.points_p_quarter] for data in fs_data_a if data.L == l])
-  
-    a_fs_amin = numpy.amin(a_fs_lines,0)
-    a_fs_amax = numpy.amax(a_fs_lines,0)
-    a_fs_mean = numpy.mean(a_fs_lines,0)
-    a_fs_stdd = numpy.std(a_fs_lines,0)
-
-    a_ho_lines = numpy.array([data.vnorm_surf_i[:,data.points_p_quarter] for data in ho_data_a if data.L == l])
-  
-    a_ho_amin = numpy.amin(a_ho_lines,0)
-    a_ho_amax = numpy.amax(a_ho_lines,0)
-    a_ho_mean = numpy.mean(a_ho_lines,0)
-    a_ho_stdd = numpy.std(a_ho_lines,0)
-
-    out_data = numpy.column_stack((fs_data_a[0].x_hat, a_fs_amin, a_fs_amax, a_fs_mean, a_fs_stdd, 
-                                                       a_ho_amin, a_ho_amax, a_ho_mean, a_ho_stdd ))
-    out_header = ['x_hat',  'full-stokes min',  'full-stokes max',  'full-stokes mean',  'full-stokes std', 
-                           'higher-order min', 'higher-order max', 'higher-order mean', 'higher-order std' ]
-    numpy.savetxt(out_path+'ExpA_Fig5_'+l+'.txt', out_data, delimiter=',', header=','.join(out_header))
-
-    plt.subplot(2,3,i+1)
-    
-    plt.fill_between(fs_data_a[0].x_hat.T, a_ho_amin, a_ho_amax, facecolor='green', alpha=0.5)
-    plt.fill_between(fs_data_a[0].x_hat.T, a_fs_amin, a_fs_amax, facecolor='blue', alpha=0.5)
-    
-    plt.plot(fs_data_a[0].x_hat.T, a_fs_mean, 'b-', linewidth=2)
-    plt.plot(fs_data_a[0].x_hat.T, a_ho_mean, 'g-', linewidth=2)
-
-    if i+1 > 3:
-        plt.xlabel('Normalized x')
-    if i+1 == 1 or i+1 == 4:
-        plt.ylabel('Velocity (m a$^{-1}$)')
-    
-    plt.title(str(int(l))+'km')
-
-plt.savefig(out_path+'ExpA_Fig5', bbox_inches='tight')
-plt.show()
-
-
-# figure 8: Results for Exp. C: norm of the surface velocity at y=L/4 for
-# different length scales L. The mean value and standard deviation are shown for
-# both types of models. 
-#   There are 6 plot boxes for 5,10,20,40,80,160 km, and all have: 
-#       x_title     = Normalized x
-#       y_title     = Velocity (m a^{-1})
-#       Blue line   = FS Mean
-#       Blue shade  = FS range
-#       Green line  = NFS mean
-#       Green shade = NFS range
-fs_data_c = [data for data in fs_data if data.E == 'c']
-ho_data_c = [data for data in ho_data if data.E == 'c']
-
-plt.figure(8, figsize=(10,8), dpi=150)
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif')
-
-plot_ls = ['005','010','020','040','080','160']
-for i, l in enumerate(plot_ls):
-    c_fs_lines = numpy.array([data.vnorm_surf_i[:,data.points_p_quarter] for data in fs_data_c if data.L == l])
-  
-    c_fs_amin = numpy.amin(c_fs_lines,0)
-    c_fs_amax = numpy.amax(c_fs_lines,0)
-    c_fs_mean = numpy.mean(c_fs_lines,0)
-    c_fs_stdd = numpy.std(c_fs_lines,0)
-
-    c_ho_lines = numpy.array([data.vnorm_surf_i[:,data.points_p_quarter] for data in ho_data_c if data.L == l])
-  
-    c_ho_amin = numpy.amin(c_ho_lines,0)
-    c_ho_amax = numpy.amax(c_ho_lines,0)
-    c_ho_mean = numpy.mean(c_ho_lines,0)
-    c_ho_stdd = numpy.std(c_ho_lines,0)
-
-    out_data = numpy.column_stack((fs_data_c[0].x_hat, c_fs_amin, c_fs_amax, c_fs_mean, c_fs_stdd, 
-                                                       c_ho_amin, c_ho_amax, c_ho_mean, c_ho_stdd ))
-    out_header = ['x_hat',  'full-stokes min',  'full-stokes max',  'full-stokes mean',  'full-stokes std', 
-                           'higher-order min', 'higher-order max', 'higher-order mean', 'higher-order std' ]
-    numpy.savetxt(out_path+'ExpC_Fig8_'+l+'.txt', out_data, delimiter=',', header=','.join(out_header))
-
-    plt.subplot(2,3,i+1)
-    
-    plt.fill_between(fs_data_c[0].x_hat.T, c_ho_amin, c_ho_amax, facecolor='green', alpha=0.5)
-    plt.fill_between(fs_data_c[0].x_hat.T, c_fs_amin, c_fs_amax, facecolor='blue', alpha=0.5)
-    
-    plt.plot(fs_data_c[0].x_hat.T, c_fs_mean, 'b-', linewidth=2)
-    plt.plot(fs_data_c[0].x_hat.T, c_ho_mean, 'g-', linewidth=2)
-
-    if i+1 > 3:
-        plt.xlabel('Normalized x')
-    if i+1 == 1 or i+1 == 4:
-        plt.ylabel('Velocity (m a$^{-1}$)')
-    
-    plt.title(str(int(l))+'km')
-
-plt.savefig(out_path+'ExpC_Fig8', bbox_inches='tight')
-plt.show()
-
-
-# figure 12: Stead state surface elevation along the central flowline for Exp. F
-# for the no-sliding (top) and sliding (bottom) experiment. The black line
-# indicates the analytical solution [Note: I don't actually see this in the
-# figure].
-#   The 2 plot boxes have: 
-#       x_title     = Distance from center (km)
-#       y_title     = Surface (m)
-#       Blue line   = FS Mean
-#       Blue shade  = FS range
-#       Green line  = NFS mean
-#       Green shade = NFS range
-fs_data_f = [data for data in fs_data if data.E == 'f']
-ho_data_f = [data for data in ho_data if data.E == 'f']
-
-plt.figure(12, figsize=(10,8), dpi=150)
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif')
-
-plot_ls = ['000','001']
-for i, l in enumerate(plot_ls):
-    f_fs_lines = numpy.array([data.surf_i[data.points_p_quarter*2,:] for data in fs_data_f if data.L == l])
-  
-    f_fs_amin = numpy.amin(f_fs_lines,0)
-    f_fs_amax = numpy.amax(f_fs_lines,0)
-    f_fs_mean = numpy.mean(f_fs_lines,0)
-    f_fs_stdd = numpy.std(f_fs_lines,0)
-
-    f_ho_lines = numpy.array([data.surf_i[data.points_p_quarter*2,:] for data in ho_data_f if data.L == l])
-  
-    f_ho_amin = numpy.amin(f_ho_lines,0)
-    f_ho_amax = numpy.amax(f_ho_lines,0)
-    f_ho_mean = numpy.mean(f_ho_lines,0)
-    f_ho_stdd = numpy.std(f_ho_lines,0)
-
-    plt.subplot(2,1,i+1)
-   
-    out_data = numpy.column_stack((fs_data_c[0].x_hat, f_fs_amin, f_fs_amax, f_fs_mean, f_fs_stdd, 
-                                                       f_ho_amin, f_ho_amax, f_ho_mean, f_ho_stdd ))
-    out_header = ['y_hat',  'full-stokes min',  'full-stokes max',  'full-stokes mean',  'full-stokes std', 
-                           'higher-order min', 'higher-order max', 'higher-order mean', 'higher-order std' ]
-    numpy.savetxt(out_path+'ExpF_Fig12_'+l+'.txt', out_data, delimiter=',', header=','.join(out_header))
-
-    plt.fill_between(ho_data_f[0].y_hat.T, f_ho_amin, f_ho_amax, facecolor='green', alpha=0.5)
-    plt.fill_between(fs_data_f[0].y_hat.T, f_fs_amin, f_fs_amax, facecolor='blue', alpha=0.5)
-    
-    plt.plot(fs_data_f[0].y_hat.T, f_fs_mean, 'b-', linewidth=2)
-    plt.plot(ho_data_f[0].y_hat.T, f_ho_mean, 'g-', linewidth=2)
-
-    if i+1 > 1:
-        plt.xlabel('Distance from center (km)')
-    if l == '000':
-        plt.title('No-Slip Bed')
-    else:
-        plt.title('Slip Bed')
-
-    plt.ylabel('Surface (m)')
-
-plt.savefig(out_path+'ExpF_Fig12', bbox_inches='tight')
-plt.show()
 
+def build_figure(build, catalog, figure, figures, orders=None):
+    """
+    Add the outputs of a figure (see select_figures) to the build and rebuild
+    the stale ones. The outputs are the ensemble statistics text file for each
+    length, which depends only on the data files of that length, and the
+    figure itself, which depends on all of them. Stale text files are written
+    now; a stale figure is appended to figures as ((plot function, arguments),
+    output file) to be rendered.
+
+    The plot function (see figure_plots) is called with (num, stats, axis) +
+    the other arguments + (output file name,). Returns the stale outputs; in a
+    dry run (see dry_run) nothing is rebuilt.
+    """
+    name, exp, lengths, axis_name, field = figure
+    plot, plot_args = figure_plots[name]
+    orders = orders or ['full_stokes','higher_order']
+    datums = catalog.query(order=orders, exp=exp, length=lengths)
+    if not datums:
+        return []
+    axis = getattr(datums[0], axis_name)
+
+    deps = {'field': field,
+            'dtype': numpy.dtype(field_dtype).name,
+            'interp': datums[0].interp_spec(),
+            'code': code_version(),
+           }
+    members = dict((l, [[d.order, d.M, ismip_cache.content_hash(d.df, cache_path)] for d in datums if d.L == l]) for l in lengths)
+    stats_files = dict((l, out_path+name+'_'+l+'.txt') for l in lengths)
+    for l in lengths:
+        build.add(stats_files[l], dict(deps, members=members[l]))
+    out_file = out_path+name
+    build.add(out_file+'.png', dict(deps, members=members, plot=[plot.__name__, plot_args],
+                                    usetex=use_latex() if usetex is None else usetex))
+
+    stale = [t for t in [stats_files[l] for l in lengths]+[out_file+'.png'] if build.is_stale(t)]
+    if not stale or dry_run:
+        return stale
+
+    stats = cached_ensemble(catalog, exp, field, lengths, orders)
+    for l in lengths:
+        if stats_files[l] in stale:
+            with ismip_profile.stage('write_stats', figure=name, length=l):
+                write_stats(stats_files[l], axis_name, axis, stats.get(('full_stokes', l)), stats.get(('higher_order', l)))
+            build.done(stats_files[l])
+    if out_file+'.png' in stale:
+        figures.append(((plot, (plot_args[0], stats, axis) + plot_args[1:] + (out_file,)), out_file+'.png'))
+    return stale
+
+
+def build_bundle(build, catalog, out_file, selected, orders=None):
+    """
+    Add the binary bundle of the selected figures' ensemble statistics (see
+    ismip_bundle) to the build and rebuild it if it's stale. It depends on
+    everything the figures' statistics text files do, so build_figure must be
+    called for each figure first. Returns the stale outputs.
+    """
+    orders = orders or ['full_stokes','higher_order']
+    stats_files = [out_path+name+'_'+l+'.txt' for name, exp, lengths, axis_name, field in selected for l in lengths]
+    build.add(out_file, {'stats': [build.targets.get(f) for f in stats_files],
+                         'version': ismip_bundle.version})
+    if not build.is_stale(out_file) or dry_run:
+        return [out_file] if build.is_stale(out_file) else []
+
+    figures = []
+    spec = None
+    for name, exp, lengths, axis_name, field in selected:
+        datums = catalog.query(order=orders, exp=exp, length=lengths)
+        if not datums:
+            continue
+        members = {}
+        for d in datums:
+            members.setdefault((d.order, d.L), []).append(d.M)
+        figures.append({'name': name, 'lengths': lengths, 'field': field,
+                        'axis_name': axis_name, 'axis': getattr(datums[0], axis_name),
+                        'stats': cached_ensemble(catalog, exp, field, lengths, orders), 'members': members})
+        spec = datums[0].interp_spec()
+    if spec is None:
+        return []
+
+    attrs = {'source': 'recreate.py',
+             'code_version': code_version(),
+             'ismip_data': os.path.abspath(ismip_data),
+             'interp_method': spec['method'],
+             'interp_code': spec['code'],
+             'points_p_quarter': spec['points_p_quarter'],
+             'field_dtype': numpy.dtype(field_dtype).name,
+            }
+    with ismip_profile.stage('bundle'):
+        ismip_bundle.write(out_file, figures, attrs)
+    build.done(out_file)
+    return [out_file]
+
+
+def run(exps=None, lengths=None, orders=None):
+    """
+    Rebuild the stale outputs of the figures (see build_figure), for lists of
+    experiments (of 'a', 'c' and 'f'), lengths (e.g. '005' or, for Exp. F,
+    '000') and model orders ('full_stokes', 'higher_order'); by default, all of
+    them. Returns the outputs that were stale.
+    """
+    catalog = ismip_catalog(ismip_data, os.path.join(cache_path, 'catalog.json'))
+    mkdir_p(out_path)
+
+    # Only the outputs whose data files, settings or code have changed since
+    # they were last built are rebuilt (see ismip_build)
+    build = ismip_build.build_graph(os.path.join(out_path, '.build.json'))
+
+    selected = select_figures(exps, lengths)
+    figures = []
+    stale = []
+    for figure in selected:
+        stale += build_figure(build, catalog, figure, figures, orders)
+
+    # Every ensemble statistic in a single binary file, e.g. for LIVVkit
+    if bundle_file is not None:
+        stale += build_bundle(build, catalog, out_path+bundle_file, selected, orders)
+
+    if dry_run:
+        for target in stale:
+            print("Would rebuild "+target)
+        if not stale:
+            print("Everything is up to date.")
+        return stale
 
-# figure 13: Norm of the stead state surface velocity along the central flowline for Exp. F
-# for the no-sliding (top) and sliding (bottom) experiment. The black line
-# indicates the analytical solution [Note: I don't actually see this in the
-# figure].
-#   The 2 plot boxes have: 
-#       x_title     = Distance from center (km)
-#       y_title     = Surface (m)
-#       Blue line   = FS Mean
-#       Blue shade  = FS range
-#       Green line  = NFS mean
-#       Green shade = NFS range
-plt.figure(13, figsize=(10,8), dpi=150)
-plt.rc('text', usetex=True)
-plt.rc('font', family='serif')
-
-plot_ls = ['000','001']
-for i, l in enumerate(plot_ls):
-    f_fs_lines = numpy.array([data.vnorm_surf_i[data.points_p_quarter*2,:] for data in fs_data_f if data.L == l])
-  
-    f_fs_amin = numpy.amin(f_fs_lines,0)
-    f_fs_amax = numpy.amax(f_fs_lines,0)
-    f_fs_mean = numpy.mean(f_fs_lines,0)
-    f_fs_stdd = numpy.std(f_fs_lines,0)
-
-    f_ho_lines = numpy.array([data.vnorm_surf_i[data.points_p_quarter*2,:] for data in ho_data_f if data.L == l])
-  
-    f_ho_amin = numpy.amin(f_ho_lines,0)
-    f_ho_amax = numpy.amax(f_ho_lines,0)
-    f_ho_mean = numpy.mean(f_ho_lines,0)
-    f_fs_stdd = numpy.std(f_fs_lines,0)
-
-    out_data = numpy.column_stack((fs_data_c[0].x_hat, f_fs_amin, f_fs_amax, f_fs_mean, f_fs_stdd, 
-                                                       f_ho_amin, f_ho_amax, f_ho_mean, f_ho_stdd ))
-    out_header = ['y_hat',  'full-stokes min',  'full-stokes max',  'full-stokes mean',  'full-stokes std', 
-                           'higher-order min', 'higher-order max', 'higher-order mean', 'higher-order std' ]
-    numpy.savetxt(out_path+'ExpF_Fig13_'+l+'.txt', out_data, delimiter=',', header=','.join(out_header))
-
-    plt.subplot(2,1,i+1)
-   
-    plt.fill_between(ho_data_f[0].y_hat.T, f_ho_amin, f_ho_amax, facecolor='green', alpha=0.5)
-    plt.fill_between(fs_data_f[0].y_hat.T, f_fs_amin, f_fs_amax, facecolor='blue', alpha=0.5)
-    
-    plt.plot(fs_data_f[0].y_hat.T, f_fs_mean, 'b-', linewidth=2)
-    plt.plot(ho_data_f[0].y_hat.T, f_ho_mean, 'g-', linewidth=2)
-
-    if i+1 > 1:
-        plt.xlabel('Distance from center (km)')
-    if l == '000':
-        plt.title('No-Slip Bed')
-    else:
-        plt.title('Slip Bed')
+    try:
+        render_all([figure for figure, target in figures], workers)
+        for figure, target in figures:
+            build.done(target)
+    finally:
+        build.save()
+    ismip_cache.evict_fields(interp_cache_size, cache_dir=cache_path)
+    return stale
 
-    plt.ylabel('Velocity (m a$^{-1}$)')
 
-plt.savefig(out_path+'ExpF_Fig13', bbox_inches='tight')
-plt.show()
+def configure(**settings):
+    """
+    Change the module's settings, e.g. configure(out_path='./out/', workers=4).
+    Unknown settings are an error.
+    """
+    for name, value in settings.items():
+        if name not in settings_names:
+            raise ValueError("Unknown setting: "+name)
+        globals()[name] = value
+
+
+# The settings configure can change
+settings_names = ['ismip_data', 'out_path', 'cache_path', 'points_p_quarter', 'interp_cache_size',
+                  'field_dtype', 'field_memory_cap', 'workers', 'headless', 'usetex', 'bundle_file',
+                  'profile_file', 'profile_summary', 'profile_memory', 'dry_run']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Recreate the ISMIP-HOM analysis figures and statistics.')
+    parser.add_argument('--exp', nargs='+', choices=['a','c','f'], type=str.lower,
+                        help='Only make the figures of these experiments.')
+    parser.add_argument('--length', nargs='+',
+                        help='Only these lengths, e.g. 005 or 160 (000 or 001 for Exp. F).')
+    parser.add_argument('--order', nargs='+', choices=['full_stokes','higher_order'],
+                        help='Only the ensembles of these model orders.')
+    parser.add_argument('--data-dir', default=ismip_data, help='Location of the ISMIP-HOM data.')
+    parser.add_argument('--out-dir', default=out_path, help='Location to output files.')
+    parser.add_argument('--cache-dir', default=cache_path, help='Location of the cache.')
+    parser.add_argument('--ppq', type=int, default=points_p_quarter,
+                        help='Interpolation grid resolution: the points per quarter of x_hat/y_hat.')
+    parser.add_argument('--workers', type=int, default=workers, help='Number of worker processes.')
+    parser.add_argument('--float32', action='store_true', help='Hold the interpolated fields as float32.')
+    parser.add_argument('--memory-cap', type=float,
+                        help='MB of interpolated fields to hold in memory before spilling them to disk.')
+    show = parser.add_mutually_exclusive_group()
+    show.add_argument('--show', dest='headless', action='store_false', default=headless,
+                      help='Show the figures as they are made.')
+    show.add_argument('--no-show', dest='headless', action='store_true', help="Only save the figures.")
+    tex = parser.add_mutually_exclusive_group()
+    tex.add_argument('--usetex', dest='usetex', action='store_true', default=usetex,
+                     help='Typeset the figure text with LaTeX (default: if it is installed).')
+    tex.add_argument('--no-usetex', dest='usetex', action='store_false', help="Don't use LaTeX.")
+    parser.add_argument('--bundle', metavar='FILE', default=bundle_file,
+                        help='Also write every statistic to this NetCDF file in the output directory.')
+    parser.add_argument('--profile', metavar='FILE', default=profile_file,
+                        help='Write a profile of each stage to this .json or .csv file in the output directory.')
+    parser.add_argument('--profile-summary', action='store_true', help='Print a summary of the profile.')
+    parser.add_argument('--no-profile-memory', action='store_true',
+                        help="Don't trace the peak memory when profiling (faster).")
+    parser.add_argument('--dry-run', action='store_true', help='Only list the outputs that would be rebuilt.')
+    args = parser.parse_args(argv)
+
+    if args.length:
+        exps = args.exp or ['a','c','f']
+        lengths = sorted(set(length for name, exp, figure_lengths, axis_name, field in figure_stats
+                             if exp in exps for length in figure_lengths))
+        bad = [length for length in args.length if length not in lengths]
+        if bad:
+            parser.error("argument --length: invalid choice(s) for Exp. {}: {} (choose from {})".format(
+                         ', '.join(e.upper() for e in exps), ', '.join(bad), ', '.join(lengths)))
+    return args
+
+
+def main(argv=None):
+    """
+    Run from the command line, profiling each stage if a profile report or
+    summary is wanted.
+    """
+    args = parse_args(argv)
+    configure(ismip_data=args.data_dir,
+              out_path=os.path.join(args.out_dir, ''),
+              cache_path=os.path.join(args.cache_dir, ''),
+              points_p_quarter=args.ppq,
+              workers=args.workers,
+              field_dtype=numpy.float32 if args.float32 else field_dtype,
+              field_memory_cap=field_memory_cap if args.memory_cap is None else int(args.memory_cap*2**20),
+              headless=args.headless,
+              usetex=args.usetex,
+              bundle_file=args.bundle,
+              profile_file=args.profile,
+              profile_summary=args.profile_summary or profile_summary,
+              profile_memory=profile_memory and not args.no_profile_memory,
+              dry_run=args.dry_run or dry_run)
+
+    profile = profile_file is not None or profile_summary
+    if profile:
+        ismip_profile.enable(profile_memory)
+    try:
+        with ismip_profile.stage('main'):
+            run(args.exp, args.length, args.order)
+    finally:
+        if profile:
+            records = ismip_profile.take()
+            ismip_profile.disable()
+            if profile_file is not None:
+                mkdir_p(out_path)
+                ismip_profile.write(out_path+profile_file, records)
+            if profile_summary:
+                print(ismip_profile.summary(records))
 
 
 
@@ -534,3 +1270,5 @@ plt.show()
 #       Green shade = NFS range
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Check the interpolation paths in ismip_interp against
+scipy.interpolate.griddata(method='linear').
+
+    python -m unittest test_ismip_interp
+"""
+
+
+import unittest
+
+import numpy
+import scipy.interpolate
+
+import ismip_interp
+
+
+def lattice(nx=13, ny=17):
+    """The points of a rectilinear lattice over the unit square, shuffled."""
+    x, y = numpy.meshgrid(numpy.linspace(0.0, 1.0, nx), numpy.linspace(0.0, 1.0, ny))
+    points = numpy.column_stack((x.ravel(), y.ravel()))
+    return points[numpy.random.RandomState(0).permutation(len(points))], 1.0/(nx-1), 1.0/(ny-1)
+
+
+def grid(points_p_quarter=10, margin=0.0):
+    """An interpolation grid, reaching margin past the unit square on each side."""
+    axis = numpy.linspace(-margin, 1.0+margin, points_p_quarter*4+1)
+    return numpy.meshgrid(axis, axis)
+
+
+def values(points):
+    """Two smooth columns of values, with f_xy of at most 1."""
+    x, y = points[:,0], points[:,1]
+    return numpy.column_stack((numpy.sin(x)*numpy.cos(y), 3.0*x - 2.0*y + 1.0))
+
+
+class interpolate_test(unittest.TestCase):
+    def test_default_matches_griddata(self):
+        points, hx, hy = lattice()
+        xi = grid(margin=0.05)
+        ref = scipy.interpolate.griddata(points, values(points), tuple(xi), method='linear')
+        new = ismip_interp.interpolate(points, values(points), xi)
+        numpy.testing.assert_allclose(new, ref, rtol=1e-12, atol=1e-12)
+
+    def test_scattered_matches_griddata(self):
+        points = numpy.random.RandomState(1).uniform(0.0, 1.0, (200, 2))
+        xi = grid()
+        ref = scipy.interpolate.griddata(points, values(points), tuple(xi), method='linear')
+        new = ismip_interp.interpolate(points, values(points), xi, structured=True)
+        numpy.testing.assert_allclose(new, ref, rtol=1e-12, atol=1e-12)
+
+    def test_rectilinear_within_cell_ambiguity(self):
+        # On a lattice, linear interpolation over either diagonal of a cell and
+        # bilinear interpolation differ by at most hx*hy/4 * max|f_xy|; a plane
+        # is reproduced exactly by all of them.
+        points, hx, hy = lattice()
+        xi = grid(margin=0.05)
+        ref = scipy.interpolate.griddata(points, values(points), tuple(xi), method='linear')
+        new = ismip_interp.interpolate(points, values(points), xi, structured=True)
+
+        numpy.testing.assert_array_equal(numpy.isnan(new), numpy.isnan(ref))
+        inside = numpy.isfinite(ref[...,0])
+        self.assertLessEqual(numpy.abs(new[...,0] - ref[...,0])[inside].max(), hx*hy/4 + 1e-12)
+        numpy.testing.assert_allclose(new[...,1][inside], ref[...,1][inside], rtol=1e-12, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, UT-BATTELLE, LLC
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Check the batched statistics in ismip_stats against brute force computations
+with ensemble_stats and deviation, on small ensembles with NaNs and ties.
+
+    python -m unittest test_ismip_stats
+"""
+
+
+import unittest
+
+import numpy
+
+import ismip_stats
+
+
+def ensemble_lines(seed=0):
+    """An ensemble of 9 lines with NaNs, tied extremes and duplicate members."""
+    rng = numpy.random.RandomState(seed)
+    lines = rng.normal(5.0, 1.0, (9, 40))
+    lines[2,3] = numpy.nan
+    lines[7,10:15] = numpy.nan
+    lines[8,:] = numpy.nan
+    lines[4] = lines[5] # tied members, at every point
+    lines[0,20] = lines[1,20] = lines[:,20].min() - 1.0 # tied minimum
+    lines[0,21] = lines[6,21] = lines[:,21].max() + 1.0 # tied maximum, one a non-member
+    lines[:,30] = 2.0 # no spread
+    lines[:,31] = 5.146720330082988 # no spread once lines[0] is left out; rounding
+    lines[0,31] += 1.0              # would make one without care
+    members = numpy.array([1, 1, 1, 0, 1, 1, 0, 1, 0], dtype=bool)
+    return lines, members
+
+
+class leave_one_out_test(unittest.TestCase):
+    def test_matches_deviation(self):
+        lines, members = ensemble_lines()
+        scores = ismip_stats.leave_one_out(lines, members)
+        for i, line in enumerate(lines):
+            stats = ismip_stats.ensemble_stats()
+            for j in numpy.nonzero(members)[0]:
+                if j != i:
+                    stats.add(lines[j])
+            expected = ismip_stats.deviation(line, stats)
+            for metric, value in expected.items():
+                numpy.testing.assert_allclose(scores[metric][i], value, rtol=1e-10, atol=1e-12,
+                                              err_msg='line {} {}'.format(i, metric))
+
+    def test_single_member(self):
+        lines, members = ensemble_lines()
+        members[:] = False
+        members[0] = True
+        scores = ismip_stats.leave_one_out(lines, members)
+        # the only member has no ensemble left to compare to
+        self.assertTrue(numpy.isnan(scores['rmse'][0]))
+        stats = ismip_stats.ensemble_stats()
+        stats.add(lines[0])
+        numpy.testing.assert_allclose(scores['rmse'][3], ismip_stats.deviation(lines[3], stats)['rmse'])
+
+
+class distances_test(unittest.TestCase):
+    def test_matches_pairs(self):
+        lines, members = ensemble_lines()
+        for chunk_bytes in [500, 64*2**20]:
+            distances = ismip_stats.distances(lines, chunk_bytes=chunk_bytes)
+            for i in range(len(lines)):
+                for j in range(len(lines)):
+                    valid = numpy.isfinite(lines[i]) & numpy.isfinite(lines[j])
+                    self.assertEqual(distances['count'][i,j], valid.sum())
+                    if not valid.any():
+                        self.assertTrue(numpy.isnan(distances['rmse'][i,j]))
+                        continue
+                    diff = lines[i][valid] - lines[j][valid]
+                    numpy.testing.assert_allclose(distances['rmse'][i,j], numpy.sqrt(numpy.mean(diff**2)))
+                    numpy.testing.assert_allclose(distances['max_abs'][i,j], numpy.abs(diff).max())
+
+
+class cube_stats_test(unittest.TestCase):
+    def test_matches_points(self):
+        lines, members = ensemble_lines()
+        cube = lines.reshape(9, 5, 8)
+        for chunk_bytes in [100, 64*2**20]:
+            stats = ismip_stats.cube_stats(list(cube), [10, 50], chunk_bytes=chunk_bytes)
+            for y in range(5):
+                for x in range(8):
+                    values = cube[:,y,x][numpy.isfinite(cube[:,y,x])]
+                    self.assertEqual(stats['count'][y,x], len(values))
+                    expected = {'min': values.min(), 'max': values.max(), 'mean': values.mean(),
+                                'std': values.std(), 'p10': numpy.percentile(values, 10),
+                                'p50': numpy.percentile(values, 50)}
+                    for name, value in expected.items():
+                        numpy.testing.assert_allclose(stats[name][y,x], value, rtol=1e-12, atol=1e-12)
+
+    def test_no_finite_values(self):
+        cube = numpy.full((3, 2, 2), numpy.nan)
+        cube[0,0,0] = 1.0
+        stats = ismip_stats.cube_stats(cube)
+        self.assertEqual(stats['count'][0,0], 1)
+        self.assertTrue(numpy.isnan(stats['mean'][1,1]))
+        self.assertEqual(stats['count'][1,1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()